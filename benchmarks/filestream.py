@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# ---------------------------------------------------------------------
+# Copyright (c) Merchise Autrement [~º/~] and Contributors
+# All rights reserved.
+#
+# This is free software; you can do what the LICENCE file allows you to.
+#
+
+'''Measure the throughput of `kaircs.service.http.FileStream`:class:.
+
+Chunks are not fetched from Riak KV (`BlobChunk.get` is replaced by a
+function that returns a chunk kept in memory), so only the streaming of the
+response is measured.  For comparison the previous streaming (reads of 4096
+bytes) is measured as well.
+
+Usage::
+
+  $ python benchmarks/filestream.py [MB]
+
+'''
+
+from __future__ import (division as _py3_division,
+                        print_function as _py3_print,
+                        absolute_import as _py3_abs_import)
+
+import sys
+import time
+
+from kaircs.vsbs import BlobStore, BlobChunk, Blob
+from kaircs.service.http import FileStream
+
+
+def memory_chunks(size):
+    data = b'x' * Blob.CHUNK_SIZE
+
+    def get(chunk):
+        if chunk.index == 0:
+            chunk.metadata.size = size
+            chunk.metadata.dirty = False
+        return data
+
+    return get
+
+
+def legacy_contents(reader, length):
+    # The streaming of FileStream before chunk-aligned reads.
+    res = reader.read(4096)
+    while res:
+        yield res
+        res = reader.read(4096)
+
+
+def chunk_aligned_contents(reader, length):
+    return FileStream(None, '/benchmark').contents(reader, length)
+
+
+def measure(contents, store, size):
+    with store.open(b'benchmark', 'r') as reader:
+        start = time.time()
+        steps = written = 0
+        for piece in contents(reader, size):
+            written += len(piece)
+            steps += 1
+        elapsed = time.time() - start
+    assert written == size
+    return elapsed, steps
+
+
+def main(megabytes=256):
+    size = megabytes * 1024 * 1024
+    BlobChunk.get = memory_chunks(size)
+    store = BlobStore({'nodes': [{'host': '127.0.0.1'}]}, 'benchmark',
+                      bucket_type=None)
+    print('%-14s %10s %10s' % ('streaming', 'MB/s', 'steps'))
+    for name, contents in (('legacy', legacy_contents),
+                           ('chunk-aligned', chunk_aligned_contents)):
+        elapsed, steps = measure(contents, store, size)
+        print('%-14s %10.1f %10d' % (name, megabytes / elapsed, steps))
+
+
+if __name__ == '__main__':
+    main(*(int(arg) for arg in sys.argv[1:]))
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# ---------------------------------------------------------------------
+# Copyright (c) Merchise Autrement [~º/~] and Contributors
+# All rights reserved.
+#
+# This is free software; you can do what the LICENCE file allows you to.
+#
+
+'''Measure the cost of path normalization per request.
+
+A request normalizes its path several times (`dirname`, `basename`, `split`
+and the `Path` descriptor of entries).  We time those calls for a set of
+distinct paths of the given depth, with the previous normalization (based
+on `os.path.realpath`:func:, which looks up every component in the local
+disk) and the current one.  The current one is measured with a cold and a
+warm memo.
+
+Usage::
+
+  $ python benchmarks/normalize.py [DEPTH [PATHS [REQUESTS]]]
+
+'''
+
+from __future__ import (division as _py3_division,
+                        print_function as _py3_print,
+                        absolute_import as _py3_abs_import)
+
+import os
+import sys
+import time
+
+from xoutil.eight.string import force as safestr
+
+from kaircs.service import fs
+
+
+def legacy_normalize(path):
+    # The normalization before it was done on the string alone.
+    from os.path import realpath, normpath
+    return safestr(realpath(normpath(path)))
+
+
+def request(path):
+    # The normalizations done while serving a request for `path`.
+    fs.normalize(path)
+    fs.dirname(path)
+    fs.basename(path)
+    fs.split(path)
+    fs.File(path, None).name
+    fs.Directory(fs.dirname(path), None).name
+
+
+def measure(paths, requests):
+    start = time.time()
+    for i in range(requests):
+        request(paths[i % len(paths)])
+    return (time.time() - start) / requests
+
+
+def main(depth=16, distinct=1000, requests=20000):
+    paths = [
+        '/' + '/'.join('dir%d-%d' % (i, level) for level in range(depth))
+        for i in range(distinct)
+    ]
+    current = fs.normalize
+    print('%d requests over %d paths with %d components' %
+          (requests, distinct, depth))
+    print('%-12s %12s' % ('normalize', 'us/request'))
+    try:
+        fs.normalize = legacy_normalize
+        print('%-12s %12.2f' % ('legacy', 1e6 * measure(paths, requests)))
+    finally:
+        fs.normalize = current
+    current.cache_clear()
+    print('%-12s %12.2f' % ('cold memo', 1e6 * measure(paths, distinct)))
+    print('%-12s %12.2f' % ('warm memo', 1e6 * measure(paths, requests)))
+
+
+if __name__ == '__main__':
+    os.chdir('/')  # make the legacy normalization see the same disk always
+    main(*(int(arg) for arg in sys.argv[1:]))
@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# ---------------------------------------------------------------------
+# Copyright (c) Merchise Autrement [~º/~] and Contributors
+# All rights reserved.
+#
+# This is free software; you can do what the LICENCE file allows you to.
+#
+
+'''Measure the cost of assembling chunks in `kaircs.vsbs.BlobWriter`:class:.
+
+Chunks are not sent to Riak KV (`BlobChunk.store` is replaced by a function
+that drops the chunk), so only the assembly is measured.  For comparison the
+previous assembly (``chunk.data += data``) is measured as well.
+
+Usage::
+
+  $ python benchmarks/writer_buffers.py [MB]
+
+Requires Python 3 (tracemalloc).
+
+'''
+
+from __future__ import (division as _py3_division,
+                        print_function as _py3_print,
+                        absolute_import as _py3_abs_import)
+
+import sys
+import time
+import tracemalloc
+
+from kaircs.vsbs import BlobStore, BlobChunk, Blob
+
+
+WRITE_SIZES = (4 * 1024, 64 * 1024, 1024 * 1024)
+
+
+def drop(chunk, store_options=None):
+    pass
+
+
+def legacy_write(total, size):
+    # The assembly of BlobWriter before the preallocated buffers.
+    piece = b'x' * size
+    data, chunk_size = b'', 0
+    for _ in range(total // size):
+        wr = 0
+        while wr < size:
+            chunk_data = piece[wr:wr + Blob.CHUNK_SIZE - chunk_size]
+            wr += len(chunk_data)
+            data += chunk_data
+            chunk_size += len(chunk_data)
+            if chunk_size == Blob.CHUNK_SIZE:
+                data, chunk_size = b'', 0
+
+
+def buffered_write(total, size, store):
+    piece = b'x' * size
+    with store.open(b'benchmark', 'w', if_none_match=True) as writer:
+        for _ in range(total // size):
+            writer.write(piece)
+
+
+def measure(fn, *args):
+    tracemalloc.start()
+    start = time.perf_counter()
+    fn(*args)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak
+
+
+def main(megabytes=64):
+    BlobChunk.store = drop
+    store = BlobStore({'nodes': [{'host': '127.0.0.1'}]}, 'benchmark',
+                      bucket_type=None)
+    total = megabytes * 1024 * 1024
+    print('%-8s %-9s %10s %10s' % ('write', 'assembly', 'ms/MB', 'peak MB'))
+    for size in WRITE_SIZES:
+        for name, fn, args in (('legacy', legacy_write, (total, size)),
+                               ('buffered', buffered_write,
+                                (total, size, store))):
+            elapsed, peak = measure(fn, *args)
+            print('%-8s %-9s %10.3f %10.2f' % (
+                '%dK' % (size // 1024), name,
+                1000 * elapsed / megabytes,
+                peak / 1024 / 1024
+            ))
+
+
+if __name__ == '__main__':
+    main(*(int(arg) for arg in sys.argv[1:]))
@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# ---------------------------------------------------------------------
+# Copyright (c) Merchise Autrement [~º/~] and Contributors
+# All rights reserved.
+#
+# This is free software; you can do what the LICENCE file allows you to.
+#
+
+'''Archives of trees of the file system, made as a stream.
+
+The archives are made from the entries yielded by
+`~kaircs.service.fs.FileSystem.export_tree`:meth:, and yielded a piece at a
+time (at most a chunk of a blob), so an archive of any size is made with
+constant memory.
+
+'''
+
+from __future__ import (division as _py3_division,
+                        print_function as _py3_print,
+                        absolute_import as _py3_abs_import)
+
+import os
+import sys
+import time
+import tarfile
+
+from .fs import dirname
+
+
+def tar_stream(tree, path):
+    '''Yield a tar archive (POSIX.1-2001) of the `tree` of `path`.
+
+    The names in the archive are relative to the parent of `path`: the
+    archive of ``/a/b`` has ``b``, ``b/c``, etc.
+
+    '''
+    written = 0
+    now = time.time()
+    for stat, reader in tree:
+        name = get_name(stat.name, path)
+        if name is None:
+            continue
+        info = tarfile.TarInfo(name)
+        info.mtime = int(stat.mtime or now)
+        if reader is None:
+            info.type = tarfile.DIRTYPE
+            info.mode = 0o755
+        else:
+            info.size = reader.blob.metadata.size
+            info.mode = 0o644
+        header = info.tobuf(tarfile.PAX_FORMAT, 'utf-8', 'surrogateescape')
+        yield header
+        written += len(header)
+        if reader is not None:
+            for data in read_blob(reader):
+                yield data
+            padding = -info.size % tarfile.BLOCKSIZE
+            yield b'\0' * padding
+            written += info.size + padding
+    # The end of the archive is two empty blocks; and the archive is padded
+    # to a whole record, like tarfile does.
+    written += 2 * tarfile.BLOCKSIZE
+    yield b'\0' * (2 * tarfile.BLOCKSIZE + -written % tarfile.RECORDSIZE)
+
+
+def zip_stream(tree, path):
+    '''Yield a zip archive of the `tree` of `path`.
+
+    Names are like in `tar_stream`:func:.  Files are deflated, and their
+    sizes and CRC are written after their data (the archive is not
+    seekable).  Files larger than 2 GiB use the Zip64 extensions.
+
+    Requires Python 3.6 or later.
+
+    '''
+    import zipfile
+    sink = _Sink()
+    now = time.time()
+    with zipfile.ZipFile(sink, 'w', zipfile.ZIP_DEFLATED,
+                         allowZip64=True) as archive:
+        for stat, reader in tree:
+            name = get_name(stat.name, path)
+            if name is None:
+                continue
+            # Zip can't represent times before 1980.
+            date_time = time.localtime(max(stat.mtime or now, 315532800))
+            if reader is None:
+                info = zipfile.ZipInfo(name + '/', date_time[:6])
+                info.external_attr = (0o40755 << 16) | 0x10
+                archive.writestr(info, b'')
+            else:
+                info = zipfile.ZipInfo(name, date_time[:6])
+                info.compress_type = zipfile.ZIP_DEFLATED
+                info.external_attr = 0o644 << 16
+                info.file_size = size = reader.blob.metadata.size
+                zip64 = size >= zipfile.ZIP64_LIMIT
+                with archive.open(info, 'w', force_zip64=zip64) as target:
+                    for data in read_blob(reader):
+                        target.write(data)
+                        yield sink.pop()
+            yield sink.pop()
+    yield sink.pop()
+
+
+#: The formats of archives: a function that yields the archive of a tree
+#: (like `tar_stream`:func:), and the content type.
+FORMATS = {'tar': (tar_stream, 'application/x-tar')}
+
+if sys.version_info >= (3, 6):
+    FORMATS['zip'] = (zip_stream, 'application/zip')
+
+
+def get_name(name, path):
+    '''Return the name in the archive of `path` of the entry `name`.
+
+    Return None for the root directory, which has no name.
+
+    '''
+    res = os.path.relpath(name, dirname(path))
+    return res if res != os.curdir else None
+
+
+def read_blob(reader):
+    '''Yield the contents of the blob of `reader`.
+
+    Each piece goes up to the end of a chunk of the blob, so that it's read
+    with a single copy.
+
+    '''
+    from ..vsbs import Blob
+    while True:
+        available = Blob.CHUNK_SIZE - reader.tell() % Blob.CHUNK_SIZE
+        data = reader.read(available)
+        if not data:
+            break
+        yield data
+
+
+class _Sink(object):
+    # An unseekable file where zipfile writes, the data written is taken
+    # with `pop`.
+    def __init__(self):
+        self.pieces = []
+
+    def write(self, data):
+        self.pieces.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def pop(self):
+        res = b''.join(self.pieces)
+        del self.pieces[:]
+        return res
@@ -0,0 +1,285 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# ---------------------------------------------------------------------
+# Copyright (c) Merchise Autrement [~º/~] and Contributors
+# All rights reserved.
+#
+# This is free software; you can do what the LICENCE file allows you to.
+#
+
+'''The KairCS service as an ASGI application.
+
+It has the same REST API as `kaircs.service.http.KairCSApplication`:class:,
+but a request only holds a thread while it's waiting for Riak KV: the calls
+to the file system run in a bounded executor, and the sockets are served by
+the event loop.  Thus many slow clients (e.g. long downloads) can be served
+by a few threads.
+
+Files are sent a chunk at a time; the next chunk is not read until the
+server has taken the previous one (``await send(...)``), so a slow client
+doesn't make us buffer the file.  Uploads are received a chunk at a time as
+well.
+
+This module requires Python 3.6 or later, and an ASGI server such as
+`uvicorn <https://www.uvicorn.org/>`_ (``pip install kaircs[asgi]``)::
+
+  $ uvicorn --factory kaircs.service.asgi:create_app
+
+'''
+
+from __future__ import (division as _py3_division,
+                        print_function as _py3_print,
+                        absolute_import as _py3_abs_import)
+
+import sys
+import asyncio
+from io import BytesIO
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+
+from werkzeug.wrappers import Request, Response
+from werkzeug.exceptions import (HTTPException, NotFound, BadRequest,
+                                 MethodNotAllowed)
+
+from xoutil.objects import delegator
+
+from .fs import dirname
+from .http import (DELEGATED_METHODS_MAP, FileStream, DirectoryStream,
+                   get_upload_content_type, get_deletion_response,
+                   get_deletion_status_response, get_bulk_files,
+                   get_bulk_response, is_interrupted)
+
+
+class AsyncKairCSApplication(delegator('fs', DELEGATED_METHODS_MAP)):
+    '''An ASGI application that serves the file system `fs`.
+
+    :param workers: The maximum number of calls to the file system (i.e.
+                    requests waiting for Riak KV) at the same time.
+
+    '''
+    methods = ('GET', 'HEAD', 'PUT', 'POST', 'DELETE')
+
+    def __init__(self, fs, workers=16):
+        self.fs = fs
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+        elif scope['type'] == 'http':
+            await self.handle(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.executor.shutdown(wait=True)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def handle(self, scope, receive, send):
+        environ = get_environ(scope)
+        request = Request(environ)
+        path = scope['path']
+        method = request.method
+        try:
+            if method in ('GET', 'HEAD'):
+                response = await self.GET(request, path)
+            elif method == 'PUT' and path != '/':
+                response = await self.PUT(request, path, receive)
+            elif method == 'DELETE' and path != '/':
+                response = await self.DELETE(path)
+            elif method == 'POST':
+                response = await self.POST(request, path, receive)
+            elif path == '/':
+                raise MethodNotAllowed(['GET', 'HEAD', 'POST'])
+            else:
+                raise MethodNotAllowed(list(self.methods))
+        except HTTPException as error:
+            response = error.get_response(environ)
+        if response is not None:
+            await self.send_response(response, environ, send)
+
+    async def GET(self, request, path):
+        if 'deletion' in request.args:
+            return await self.run(self.deletion_status, path)
+        try:
+            stat = await self.run(self.stat, path)
+        except EnvironmentError:
+            raise NotFound
+        if stat.kind == 'dir':
+            resource = DirectoryStream(self, path, stat)
+        else:
+            resource = FileStream(self, path, stat)
+        return await self.run(resource.respond, request)
+
+    async def PUT(self, request, path, receive):
+        '''Store the body of the request in `path`.
+
+        Return None if the client disconnects; the file is not added to
+        its directory (it was never closed).
+
+        '''
+        from ..vsbs import Blob
+
+        def open_target():
+            if self.exists(path) and self.isdir(path):
+                raise BadRequest
+            self.mkdir(dirname(path), exist_ok=True)
+            content_type = get_upload_content_type(request)
+            return self.open(path, 'w', content_type=content_type)
+
+        target = await self.run(open_target)
+        buffer = bytearray()
+        more_body = True
+        while more_body:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return None
+            buffer += message.get('body', b'')
+            more_body = message.get('more_body', False)
+            if len(buffer) >= Blob.CHUNK_SIZE or not more_body:
+                await self.run(target.write, buffer)
+                buffer = bytearray()
+        await self.run(target.close)
+        return Response(status=201)
+
+    async def POST(self, request, path, receive):
+        '''Upload many files under the directory `path`.
+
+        Like `kaircs.service.http.KairCSApplication.POST`:meth:, but the
+        body is received first, into a temporary file (kept in memory up to
+        the size of a chunk).  Return None if the client disconnects.
+
+        '''
+        from tempfile import SpooledTemporaryFile
+        from ..vsbs import Blob
+        with SpooledTemporaryFile(max_size=Blob.CHUNK_SIZE) as body:
+            more_body = True
+            while more_body:
+                message = await receive()
+                if message['type'] == 'http.disconnect':
+                    return None
+                body.write(message.get('body', b''))
+                more_body = message.get('more_body', False)
+            environ = dict(request.environ)
+            environ['CONTENT_LENGTH'] = str(body.tell())
+            environ['wsgi.input'] = body
+            body.seek(0)
+            request = Request(environ)
+
+            def upload():
+                files = get_bulk_files(request)
+                return get_bulk_response(path, self.fs.write_files(path,
+                                                                   files))
+
+            return await self.run(upload)
+
+    async def DELETE(self, path):
+        def delete():
+            if not self.exists(path) and not is_interrupted(self.fs, path):
+                raise NotFound
+            self.rm(path, recursive=True, wait=False)
+
+        await self.run(delete)
+        return get_deletion_response(path)
+
+    def deletion_status(self, path):
+        return get_deletion_status_response(self.fs, path)
+
+    async def send_response(self, response, environ, send):
+        '''Send a `werkzeug.wrappers.Response`:class:.
+
+        The body is iterated in the executor, since it may read a blob.
+
+        '''
+        body, status, headers = response.get_wsgi_response(environ)
+        await send({
+            'type': 'http.response.start',
+            'status': int(status.split(None, 1)[0]),
+            'headers': [
+                (name.lower().encode('latin-1'), value.encode('latin-1'))
+                for name, value in headers
+            ],
+        })
+        body = iter(body)
+        try:
+            while True:
+                data = await self.run(next, body, None)
+                if data is None:
+                    break
+                elif data:
+                    await send({'type': 'http.response.body',
+                                'body': data,
+                                'more_body': True})
+            await send({'type': 'http.response.body'})
+        finally:
+            close = getattr(body, 'close', None)
+            if close is not None:
+                close()
+            response.close()
+
+    def run(self, fn, *args, **kwargs):
+        '''Call `fn` in the executor.'''
+        loop = asyncio.get_event_loop()
+        return loop.run_in_executor(self.executor,
+                                    partial(fn, *args, **kwargs))
+
+
+def get_environ(scope):
+    '''Return the WSGI environment that matches the ASGI `scope`.
+
+    ``wsgi.input`` is empty; the body is received by the application.
+
+    '''
+    server_name, server_port = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode().decode('latin-1'),
+        'PATH_INFO': scope['path'].encode().decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server_name,
+        'SERVER_PORT': str(server_port),
+        'SERVER_PROTOCOL': 'HTTP/%s' % scope.get('http_version', '1.1'),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': BytesIO(),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope.get('headers', ()):
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            name = 'HTTP_' + name
+        if name in environ:
+            environ[name] += ',' + value
+        else:
+            environ[name] = value
+    return environ
+
+
+def create_app():
+    '''Return the application configured by the environment.
+
+    See `kaircs.service.config`:mod:.
+
+    '''
+    from .config import load_config, create_filesystem
+    config = load_config()
+    return AsyncKairCSApplication(create_filesystem(config),
+                                  workers=config['threads'])
+
+
+def main():
+    import uvicorn
+    from .config import load_config
+    host, _, port = load_config()['bind'].rpartition(':')
+    uvicorn.run(create_app(), host=host, port=int(port))
+
+
+if __name__ == '__main__':
+    main()
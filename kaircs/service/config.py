@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# ---------------------------------------------------------------------
+# Copyright (c) Merchise Autrement [~º/~] and Contributors
+# All rights reserved.
+#
+# This is free software; you can do what the LICENCE file allows you to.
+#
+
+'''Configuration of the KairCS service.
+
+The configuration is read from an INI file with the sections ``[kaircs]``
+(the file system) and ``[server]`` (the HTTP server)::
+
+  [kaircs]
+  nodes = riak1:8098 riak2:8098
+  name = store
+  dir_bucket_type = maps
+
+  [server]
+  bind = 0.0.0.0:5000
+  workers = 4
+  max_requests = 10000
+
+The file is given by the argument `filename` or the environment variable
+``KAIRCS_CONFIG``.  Any option can be overridden by the environment variable
+``KAIRCS_<OPTION>`` (e.g. ``KAIRCS_NODES`` or ``KAIRCS_WORKERS``).  See
+`OPTIONS`:data: for the options and their defaults.
+
+'''
+
+from __future__ import (division as _py3_division,
+                        print_function as _py3_print,
+                        absolute_import as _py3_abs_import)
+
+import os
+
+
+def nodes(value):
+    '''Parse a list of Riak KV nodes.
+
+    Each node is ``host[:http_port[:pb_port]]``; nodes are separated by
+    spaces or commas.
+
+    '''
+    res = []
+    for node in value.replace(',', ' ').split():
+        host, _, ports = node.partition(':')
+        http_port, _, pb_port = ports.partition(':')
+        node = {'host': host}
+        if http_port:
+            node['http_port'] = int(http_port)
+        if pb_port:
+            node['pb_port'] = int(pb_port)
+        res.append(node)
+    return res
+
+
+def boolean(value):
+    value = value.strip().lower()
+    if value in ('1', 'yes', 'true', 'on'):
+        return True
+    elif value in ('0', 'no', 'false', 'off'):
+        return False
+    else:
+        raise ValueError('Not a boolean: "%s"' % value)
+
+
+#: The options as a map from names to ``(section, type, default)``.
+OPTIONS = {
+    # The file system.
+    'nodes': ('kaircs', nodes, '127.0.0.1:8098'),
+    'name': ('kaircs', str, 'store'),
+    'dir_bucket_type': ('kaircs', str, 'maps'),
+    'bucket_type': ('kaircs', str, 'vsbs'),
+    'store_workers': ('kaircs', int, '0'),
+    'dir_cache_size': ('kaircs', int, '0'),
+    'dir_cache_ttl': ('kaircs', float, '5'),
+    'delete_workers': ('kaircs', int, '8'),
+    'upload_workers': ('kaircs', int, '8'),
+    'dedup': ('kaircs', boolean, 'no'),
+    'refcount_bucket_type': ('kaircs', str, 'counters'),
+    'compression': ('kaircs', str, ''),
+    'small_blob_size': ('kaircs', int, '65536'),
+    'delete_window': ('kaircs', int, '8'),
+    'chunk_cache_dir': ('kaircs', str, ''),
+    'chunk_cache_size': ('kaircs', int, '1073741824'),
+    # The server.
+    'app': ('server', str, 'wsgi'),
+    'bind': ('server', str, '0.0.0.0:5000'),
+    'workers': ('server', int, '2'),
+    'threads': ('server', int, '8'),
+    'max_requests': ('server', int, '0'),
+    'max_requests_jitter': ('server', int, '0'),
+    'timeout': ('server', int, '30'),
+    'graceful_timeout': ('server', int, '30'),
+    'debug': ('server', boolean, 'no'),
+}
+
+
+def load_config(filename=None, environ=None):
+    '''Return the configuration as a dict from option names to values.
+
+    Raise `ValueError`:class: if the file is given but it cannot be read, or
+    if a value is not valid.
+
+    '''
+    try:
+        from configparser import ConfigParser
+    except ImportError:
+        from ConfigParser import SafeConfigParser as ConfigParser
+    if environ is None:
+        environ = os.environ
+    if filename is None:
+        filename = environ.get('KAIRCS_CONFIG')
+    parser = ConfigParser()
+    if filename and not parser.read([filename]):
+        raise ValueError('Cannot read the configuration file "%s"' % filename)
+    res = {}
+    for option, (section, type, default) in OPTIONS.items():
+        value = environ.get('KAIRCS_%s' % option.upper())
+        if value is None:
+            if parser.has_option(section, option):
+                value = parser.get(section, option)
+            else:
+                value = default
+        try:
+            res[option] = type(value)
+        except ValueError:
+            raise ValueError('Invalid value for "%s": "%s"' % (option, value))
+    return res
+
+
+def create_filesystem(config):
+    '''Return the `~kaircs.service.fs.FileSystem`:class: of `config`.'''
+    from .fs import FileSystem
+    store_options = dict(bucket_type=config['bucket_type'],
+                         small_blob_size=config['small_blob_size'],
+                         delete_window=config['delete_window'])
+    if config['store_workers']:
+        store_options['workers'] = config['store_workers']
+    if config['compression']:
+        store_options['compression'] = config['compression']
+    if config['chunk_cache_dir']:
+        store_options.update(
+            chunk_cache_dir=config['chunk_cache_dir'],
+            chunk_cache_size=config['chunk_cache_size'],
+        )
+    if config['dedup']:
+        store_options.update(
+            dedup=True,
+            refcount_bucket_type=config['refcount_bucket_type'],
+        )
+    return FileSystem(
+        config['nodes'],
+        config['name'],
+        store_options=store_options,
+        dir_bucket_type=config['dir_bucket_type'],
+        dir_cache_size=config['dir_cache_size'],
+        dir_cache_ttl=config['dir_cache_ttl'],
+        delete_workers=config['delete_workers'],
+        upload_workers=config['upload_workers'],
+    )
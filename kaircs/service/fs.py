@@ -13,7 +13,13 @@ from __future__ import (division as _py3_division,
                         print_function as _py3_print,
                         absolute_import as _py3_abs_import)
 import os
+import time
+import itertools
+import threading
+from collections import OrderedDict, deque, namedtuple
+
 from xoutil.eight.string import force as safestr
+from xoutil.future.functools import lru_cache
 
 from kaircs.vsbs import BlobStore
 
@@ -29,11 +35,29 @@ class FileSystem(object):
     :param dir_bucket_type: The name of the bucket type to use for the
                             store. If None raise `<RiakError>`:class:..
 
+    :param dir_cache_size: The maximum number of directories to keep in the
+                           `directory cache <DirectoryCache>`:class:.  If 0
+                           (the default) directories are always fetched.
+
+    :param dir_cache_ttl: The amount of seconds a directory is kept in the
+                          cache.  Changes to a directory done by other
+                          processes may go unnoticed for this long.
+
+    :param delete_workers: The amount of files (or directories) deleted at
+                           the same time by `rm`:meth:.
+
+    :param upload_workers: The amount of files written at the same time by
+                           `write_files`:meth:.
+
     '''
     def __init__(self, nodes, name, store_options=None,
-                 dir_bucket_type=None):
+                 dir_bucket_type=None, dir_cache_size=0, dir_cache_ttl=5,
+                 delete_workers=8, upload_workers=8):
         from riak import RiakClient
+        self.upload_workers = upload_workers
         self.riak = RiakClient(nodes=nodes)
+        self.dircache = DirectoryCache(dir_cache_size, dir_cache_ttl)
+        self.deletions = DeletionQueue(self, workers=delete_workers)
         name = safestr(name)
         files_store_name = '%s-files' % name
         dirs_store_name = '%s-dirs' % name
@@ -49,6 +73,7 @@ class FileSystem(object):
         self.root = Directory(ROOT, self)
 
     def close(self):
+        self.deletions.close()
         self.files.close()
         self.riak.close()
 
@@ -65,6 +90,45 @@ class FileSystem(object):
             if name != ROOT:
                 self.rm(name, recursive=True)
 
+    def get_entries(self, hash):
+        '''Return the entries of the directory with the given `hash`.
+
+        Return a dict from names to the hashes of the entries.  The result
+        may come from the directory cache, so don't modify it.
+
+        '''
+        return self.get_listing(hash)[0]
+
+    def get_listing(self, hash):
+        '''Return the entries of the directory with the given `hash`.
+
+        Return a tuple ``(entries, info)``.  `entries` is like the result of
+        `get_entries`:meth:.  `info` is a dict from the names of files to
+        dicts with their ``size``, ``mtime`` and ``content_type`` (see
+        `Stat`:class:).  Files written by older versions have no info.
+
+        The result may come from the directory cache, so don't modify it.
+
+        '''
+        listing = self.dircache.get(hash)
+        if listing is None:
+            generation = self.dircache.generation(hash)
+            entries, info = {}, {}
+            for (name, datatype), value in self.get_map(hash).value.items():
+                if datatype == 'register':
+                    entries[name] = value
+                elif datatype == 'map':
+                    info[name] = FileInfo.parse(value)
+            listing = entries, info
+            self.dircache.put(hash, listing, generation)
+        return listing
+
+    def get_map(self, hash):
+        '''Fetch the map of the directory with the given `hash`.'''
+        # `self.dirs.get()` would look up the properties of the bucket type
+        # (i.e. a request to Riak) to find out that it holds maps.
+        return self.riak.fetch_datatype(self.dirs, hash)
+
     def mkdir(self, name, traverse=True, *args, **kwargs):
         '''Create directory under `name`.
 
@@ -82,34 +146,28 @@ class FileSystem(object):
         from xoutil.params import ParamManager
         pm = ParamManager(args, kwargs)
         exist_ok = pm(0, 'exist_ok', 'exists_ok', default=False)
-
-        def _mkdir(name, traverse, exist_ok):
-            if not name.startswith(ROOT):
-                raise ValueError('Cannot create relative path "%s"' % name)
-            directory = Directory(name, self)
-            if not self.exists(directory.name):
-                parent = directory.parent
-                if traverse and directory != self.root:
-                    parent = _mkdir(
-                        parent.name,
-                        traverse=traverse,
-                        exist_ok=True
-                    )
-                if self.exists(parent.name):
-                    base = basename(name)
-                    parent[base] = directory
-                else:
-                    raise EnvironmentError(
-                        '"%s": No such file or directory' % parent.name
-                    )
-            else:
-                if not self.isdir(directory.name):
-                    raise EnvironmentError('File "%s" already exists' % name)
-                elif not exist_ok:
-                    raise EnvironmentError('Entry "%s" already exists' % name)
-            return directory
-
-        _mkdir(name=name, traverse=traverse, exist_ok=exist_ok)
+        if not name.startswith(ROOT):
+            raise ValueError('Cannot create relative path "%s"' % name)
+        stat, missing = self._lookup(name)
+        if not missing:
+            if stat.kind != Directory.namespace:
+                raise EnvironmentError('File "%s" already exists' % name)
+            elif not exist_ok:
+                raise EnvironmentError('Entry "%s" already exists' % name)
+        elif stat.kind == Tombstone.namespace:
+            raise EnvironmentError('"%s" is being deleted' % stat.name)
+        elif stat.kind != Directory.namespace:
+            raise EnvironmentError('File "%s" already exists' % stat.name)
+        elif not traverse and len(missing) > 1:
+            raise EnvironmentError(
+                '"%s": No such file or directory' % dirname(name)
+            )
+        else:
+            parent = Directory(stat.name, self)
+            for base in missing:
+                directory = Directory(os.path.join(parent.name, base), self)
+                parent[base] = directory
+                parent = directory
 
     def put(self, filename, name=None):
         from shutil import copyfileobj
@@ -122,28 +180,89 @@ class FileSystem(object):
             with self.open(name, 'w') as target:
                 copyfileobj(source, target, 4 * Blob.CHUNK_SIZE)
 
+    def write_files(self, base, files, workers=None, batch_size=256):
+        '''Write many files under the directory `base`.
+
+        `files` is an iterable of tuples ``(path, data, content_type)``.  The
+        `path` is relative to `base`; paths outside of it are rejected.
+        `data` is the contents of the file (bytes), a file-like object, or
+        None to create a directory.  If `content_type` is None, it's guessed
+        from the path.
+
+        Directories are created as needed, and each one is looked up once.
+        Files given as bytes are written by up to `workers` threads at the
+        same time (`upload_workers` by default).  File objects are written
+        in the calling thread before the next item of `files` is taken, so
+        they can come from a stream (e.g. a tar archive).  Written files are
+        added to their directories in batches of up to `batch_size`, a
+        single update of the map of the directory for each batch.
+
+        Existing files are not overwritten.  Errors don't stop the writing.
+
+        Return a list with the `WriteResult`:class: of each item of
+        `files`.
+
+        '''
+        if workers is None:
+            workers = self.upload_workers
+        upload = BulkWrite(self, base, workers=workers,
+                           batch_size=batch_size)
+        return upload.run(files)
+
+    def stat(self, path):
+        '''Return the `Stat`:class: of the entry at `path`.
+
+        Raise `EnvironmentError`:class:. if path does not exists.
+
+        '''
+        stat, missing = self._lookup(path)
+        if missing:
+            raise EnvironmentError('%s: No such file or directory' % path)
+        return stat
+
+    resolve = stat
+
+    def _lookup(self, path):
+        '''Walk `path` from the root.
+
+        The entries of each directory in the path are fetched once.
+
+        Return a tuple ``(stat, missing)``: the `Stat`:class: of the deepest
+        entry found, and the list of the components of `path` not found after
+        it.  If `path` exists `missing` is empty.
+
+        An entry being deleted is missing, but `stat` is its `tombstone
+        <Tombstone>`:class: so that it's not created again meanwhile.
+
+        '''
+        components = [c for c in normalize(path).split(os.path.sep) if c]
+        root = Directory(ROOT, self)
+        stat = Stat(root.name, root.namespace, root.hash, None)
+        for i, component in enumerate(components):
+            if stat.kind != Directory.namespace:
+                return stat, components[i:]
+            entries, info = self.get_listing(stat.hash)
+            hash = entries.get(component)
+            if not hash:
+                return stat, components[i:]
+            stat = Stat.from_hash(hash, stat.name, info.get(component))
+            if stat.kind == Tombstone.namespace:
+                return stat, components[i:]
+        return stat, []
+
     def exists(self, path):
         '''Test if a path exists.
 
         '''
-        if path == ROOT:
-            return True
-        dirname, base = split(path)
-        dir = Directory(dirname, self)
-        return base in dir and self.exists(dir.name)
+        _, missing = self._lookup(path)
+        return not missing
 
     def isdir(self, path):
         '''Test if a path is a directory.
 
         Raise `EnvironmentError`:class:. if path does not exists.
         '''
-        if path == ROOT:
-            return True
-        if not self.exists(path):
-            raise EnvironmentError('%s: No such file or directory' % path)
-        dirname, base = split(path)
-        dir = Directory(dirname, self)
-        return isinstance(dir[base], Directory)
+        return self.stat(path).kind == Directory.namespace
 
     def cat(self, path):
         if self.isdir(path):
@@ -152,29 +271,78 @@ class FileSystem(object):
         _file = File(path, self)
         return self.files.read(_file.name)
 
-    def rm(self, path, recursive=False):
+    def rm(self, path, recursive=False, wait=True):
         '''Remove entries under path.
 
         Raise `EnvironmentError`:class:. if trying to delete a directory
         without recursive=True.
+
+        The entry is replaced by a `tombstone <Tombstone>`:class: in its
+        parent directory right away; then the files and directories under it
+        are deleted by the `deletion queue <DeletionQueue>`:class:, and
+        finally the tombstone is removed.  Meanwhile `path` doesn't exist,
+        but it can't be created again (by any process).  If `wait` is False,
+        return without waiting for the deletion; the progress is given by
+        `deletion_status`:meth:.
+
+        If `path` is being deleted, raise `EnvironmentError`:class:; unless
+        its tombstone is `stale <Tombstone>`:class:, then the deletion is
+        resumed.
+
+        Return the `Deletion`:class:.  If `wait` is True and some file could
+        not be deleted, raise `EnvironmentError`:class:.
+
         '''
         if path == ROOT:
             raise ValueError('Cannot remove /')
-        if self.isdir(path) and not recursive:
+        stat, missing = self._lookup(path)
+        if stat.kind == Tombstone.namespace and stat.name == normalize(path):
+            if not Tombstone.is_stale(stat):
+                raise EnvironmentError('"%s" is being deleted' % stat.name)
+        elif missing:
+            raise EnvironmentError('%s: No such file or directory' % path)
+        elif stat.kind == Directory.namespace and not recursive:
             raise EnvironmentError('Recursive must be True to'
                                    'remove a directory')
-        else:
-            l = self.ls(path, recursive=recursive)  # noqa: E741
-            # ls return top down so we revert it to go up.
-            l.reverse()
-            for p in l:
-                if not self.isdir(p):
-                    self.files.delete(p)
-                parent = self.dirs.get(
-                    Directory(dirname(p), self).hash
-                )
-                del parent.registers[basename(p)]
-                parent.store()
+        parent_hash = Directory(stat.parent, self).hash
+        parent = self.get_map(parent_hash)
+        name = basename(stat.name)
+        parent.registers[name].assign(Tombstone(stat.name, self).hash)
+        # The heartbeat of the deletion (see `Tombstone`:class:).
+        FileInfo(0, time.time(), '').assign(parent.maps[name])
+        parent.store(return_body=False)
+        self.dircache.invalidate(parent_hash)
+        deletion = self.deletions.submit(stat, wait=wait)
+        if wait and deletion.errors:
+            name, error = deletion.errors[0]
+            raise EnvironmentError('Cannot remove "%s": %s' %
+                                   (name, error))
+        return deletion
+
+    def deletion_status(self, path):
+        '''Return the status of the deletion of `path`.
+
+        The state comes from the `tombstone <Tombstone>`:class: of `path` (or
+        of an ancestor), so it's the same in every process: ``'running'``
+        while there is one, ``'interrupted'`` if it's stale, and ``'done'``
+        when it's gone.  If this process runs (or ran) the deletion, the
+        status has its progress too, see `Deletion.status`:meth:; and a
+        finished deletion may have ``'failed'``.
+
+        '''
+        stat, _ = self._lookup(path)
+        try:
+            status = self.deletions.status(path)
+        except KeyError:
+            status = dict(path=normalize(path))
+        if stat.kind == Tombstone.namespace:
+            if Tombstone.is_stale(stat):
+                status['state'] = 'interrupted'
+            elif status.get('state') not in ('queued', 'running'):
+                status['state'] = 'running'
+        elif status.get('state') not in ('done', 'failed'):
+            status['state'] = 'done'
+        return status
 
     def ls(self, path, recursive=False):
         '''List entries under path.
@@ -182,41 +350,312 @@ class FileSystem(object):
         Return a list of entry names. If `path` points to a file, return a
         list with a single entry.  If `path` does not exist raise
         `EnvironmentError`:class:.
+
+        If `recursive` is True, the directories are fetched concurrently (see
+        `walk`:meth:); each directory comes before its entries.
+
         '''
         res = [path]
-        if self.isdir(path):
-            for child in Directory(path, self).children:
-                child_path = os.path.join(path, child)
-                if not recursive:
-                    res.append(child_path)
-                else:
-                    res += self.ls(child_path, recursive=True)
+        stat = self.stat(path)
+        start = len(stat.name.rstrip(os.path.sep)) + 1
+        res.extend(
+            os.path.join(path, entry.name[start:])
+            for entry in self._tree(stat, recursive=recursive)
+        )
         return res
 
-    def open(self, path, mode='r'):
+    def scandir(self, path):
+        '''Return the `Stat`:class: of the entries of the directory `path`.
+
+        The entries are sorted by name.  Only the map of the directory (and
+        those of its ancestors) are fetched.  `path` may also be the
+        `Stat`:class: of a directory, so that it's not looked up again.
+
+        Raise `EnvironmentError`:class: if `path` does not exist or is not
+        a directory.
+
+        '''
+        stat = path if isinstance(path, Stat) else self.stat(path)
+        if stat.kind != Directory.namespace:
+            raise EnvironmentError('%s: Not a directory' % stat.name)
+        return sorted(self._tree(stat), key=lambda entry: entry.name)
+
+    def walk(self, path, window=16):
+        '''Walk the tree under the directory `path`.
+
+        Like `os.walk`:func:, yield a tuple ``(dirpath, dirnames, filenames)``
+        for each directory, starting with `path`.  You may remove names from
+        `dirnames` to skip those directories.
+
+        The tree is walked breadth-first: up to `window` directories are
+        fetched concurrently, and each one is yielded as soon as it's fetched.
+
+        If `path` is not a directory, yield nothing.  If `path` does not exist
+        raise `EnvironmentError`:class:.
+
+        '''
+        for stat, entries in self._iterwalk(self.stat(path), window=window):
+            dirs, files = [], []
+            for entry in entries:
+                name = os.path.basename(entry.name)
+                if entry.kind == Directory.namespace:
+                    dirs.append(name)
+                else:
+                    files.append(name)
+            yield stat.name, dirs, files
+            if len(dirs) < sum(e.kind == Directory.namespace for e in entries):
+                entries[:] = [
+                    entry
+                    for entry in entries
+                    if entry.kind != Directory.namespace or
+                    os.path.basename(entry.name) in dirs
+                ]
+
+    def _iterwalk(self, stat, window=16):
+        '''Walk the tree under the directory `stat` breadth-first.
+
+        Yield a tuple ``(stat, entries)`` for every directory, where `entries`
+        is the list of the `Stat`:class: of its entries.  The directories
+        that remain in `entries` after the yield are walked.
+
+        Up to `window` directories are fetched concurrently.
+
+        '''
+        if stat.kind != Directory.namespace:
+            return
+        executor = self.files.executor
+        pending, in_flight = deque([stat]), deque()
+        while pending or in_flight:
+            while pending and len(in_flight) < window:
+                directory = pending.popleft()
+                future = executor.submit(self.get_listing, directory.hash)
+                in_flight.append((directory, future))
+            directory, future = in_flight.popleft()
+            entries = self._stat_entries(directory, future.result())
+            yield directory, entries
+            pending.extend(
+                entry
+                for entry in entries
+                if entry.kind == Directory.namespace
+            )
+
+    def export_tree(self, path, window=4, readahead=2):
+        '''Walk the tree under `path` to archive it.
+
+        Yield a tuple ``(stat, reader)`` for `path` and every entry under
+        it, directories before their entries.  `reader` is None for
+        directories, and an open `~kaircs.vsbs.BlobReader`:class: for files.
+        The reader is closed when the next entry is taken, so read it before.
+
+        Up to `window` files are opened ahead (concurrently, in the executor
+        of the store) while the current one is read, and each reader fetches
+        up to `readahead` chunks ahead.  Thus the memory used doesn't depend
+        on the size of the tree nor of its files.
+
+        Files that can't be opened (e.g. being written, or deleted since the
+        directory was fetched) are skipped.
+
+        If `path` does not exist raise `EnvironmentError`:class:.
+
+        '''
+        stat = self.stat(path)
+        if stat.kind == Directory.namespace:
+            entries = self._iterexport(stat)
+        else:
+            entries = [stat]
+        executor = self.files.executor
+        in_flight = deque()
+
+        def open_reader(stat):
+            _file = File(stat.name, self)
+            return self.files.open(_file.name, 'r', readahead=readahead)
+
+        def take():
+            # Return None if the file is skipped.
+            stat, future = in_flight.popleft()
+            if future is None:
+                return stat, None
+            try:
+                return stat, future.result()
+            except (KeyError, EnvironmentError):
+                return None
+
+        try:
+            # The None at the end takes the files still in flight.
+            for entry in itertools.chain(entries, [None]):
+                if entry is None:
+                    pass
+                elif entry.kind == Directory.namespace:
+                    in_flight.append((entry, None))
+                else:
+                    future = executor.submit(open_reader, entry)
+                    in_flight.append((entry, future))
+                while in_flight and (entry is None or
+                                     len(in_flight) > window):
+                    taken = take()
+                    if taken is None:
+                        continue
+                    stat, reader = taken
+                    try:
+                        yield stat, reader
+                    finally:
+                        if reader is not None:
+                            reader.close()
+        finally:
+            for _, future in in_flight:
+                if (future is not None and not future.cancel() and
+                        future.exception() is None):
+                    future.result().close()
+
+    def _iterexport(self, stat):
+        # Every directory (when it's walked) followed by its files.
+        for directory, entries in self._iterwalk(stat):
+            yield directory
+            for entry in entries:
+                if entry.kind != Directory.namespace:
+                    yield entry
+
+    def _tree(self, stat, recursive=False):
+        '''Return the `Stat`:class: of the entries under `stat`.
+
+        If `stat` is not a directory, return an empty list.  If `recursive`
+        is True, include the entries of sub-directories; each directory comes
+        before its entries.
+
+        '''
+        if not recursive:
+            if stat.kind == Directory.namespace:
+                return self._stat_entries(stat, self.get_listing(stat.hash))
+            else:
+                return []
+        else:
+            res = []
+            for _, entries in self._iterwalk(stat):
+                res.extend(entries)
+            return res
+
+    @staticmethod
+    def _stat_entries(directory, listing):
+        '''Return the `Stat`:class: of the entries in the `listing` of
+        `directory`, but those being deleted.
+
+        '''
+        entries, info = listing
+        return [
+            Stat.from_hash(hash, directory.name, info.get(name))
+            for name, hash in entries.items()
+            if not hash.startswith(Tombstone.namespace + '::')
+        ]
+
+    def open(self, path, mode='r', **options):
         '''Open file to read or write.
 
         Raise `EnvironmentError`:class:. if trying to open a directory, if
         parent directory does not exists or if `path` does not exists and file
         is trying to be open for reading.
+
+        The `options` are passed to `kaircs.vsbs.BlobStore.open`:meth:.
+
+        When writing, the file is added to its directory after the writer is
+        closed, along with its size, the current time and its content type:
+        either the `content_type` option or the one guessed from `path`.
+
         '''
         parent = dirname(path)
-        if not self.isdir(parent):
+        stat, missing = self._lookup(path)
+        if mode == 'w' and stat.kind == Tombstone.namespace:
+            raise EnvironmentError('"%s" is being deleted' % stat.name)
+        if len(missing) > 1 or (missing and stat.kind != Directory.namespace):
             raise EnvironmentError('%s: No such file or directory.' % parent)
-        if mode == 'r' and not self.exists(path):
+        if mode == 'r' and missing:
             raise EnvironmentError('%s: No such file or directory.' % path)
-        if self.exists(path) and self.isdir(path):
+        if not missing and stat.kind == Directory.namespace:
             raise EnvironmentError('%s: Is a directory.' % path)
         _file = File(path, self)
         if mode == 'w':
             base = basename(path)
-            Directory(parent, self)[base] = _file
-        return self.files.open(_file.name, mode)
+            directory = Directory(parent, self)
+            content_type = options.pop('content_type', None)
+            if not content_type:
+                content_type = guess_type(path)
+
+            def on_close(writer):
+                info = FileInfo(writer.written, time.time(), content_type)
+                directory.set(base, _file, info)
+
+            options['on_close'] = on_close
+        return self.files.open(_file.name, mode, **options)
 
     def link(self, name, refer, symlink=False):
         pass
 
 
+class Stat(namedtuple('Stat', 'name kind hash parent size mtime '
+                      'content_type')):
+    '''The result of `FileSystem.stat`:meth:.
+
+    - `name` is the (normalized) path of the entry.
+    - `kind` is the namespace of the entry: 'dir', 'file' or 'link'.
+    - `hash` is the hash of the entry; as stored in its directory.
+    - `parent` is the path of the parent directory (None for the root).
+    - `size`, `mtime` and `content_type` are the size of a file, the time it
+      was written and its content type.  They are None for directories and
+      for files written by older versions.
+
+    '''
+    __slots__ = ()
+
+    def __new__(cls, name, kind, hash, parent, size=None, mtime=None,
+                content_type=None):
+        return super(Stat, cls).__new__(cls, name, kind, hash, parent, size,
+                                        mtime, content_type)
+
+    @classmethod
+    def from_hash(cls, hash, parent, info=None):
+        '''Return the Stat of the entry with the given `hash`.'''
+        kind, name = hash.split('::', 1)
+        if info is None:
+            return cls(name, kind, hash, parent)
+        else:
+            return cls(name, kind, hash, parent, *info)
+
+
+class FileInfo(namedtuple('FileInfo', 'size mtime content_type')):
+    '''The size, time of writing and content type of a file.
+
+    Stored in the map of its directory, as a map with the same name as the
+    file.
+
+    '''
+    __slots__ = ()
+
+    def assign(self, map):
+        '''Assign the registers of `map` (a Riak KV map).'''
+        map.registers['size'].assign(safestr('%d' % self.size))
+        map.registers['mtime'].assign(safestr('%.3f' % self.mtime))
+        map.registers['content_type'].assign(safestr(self.content_type))
+
+    @classmethod
+    def parse(cls, value):
+        '''Return the FileInfo from the `value` of a Riak KV map.'''
+        def get(name, convert):
+            res = value.get((name, 'register'))
+            return convert(res) if res is not None else None
+
+        return cls(get('size', int), get('mtime', float),
+                   get('content_type', safestr))
+
+
+class WriteResult(namedtuple('WriteResult', 'path size error')):
+    '''The result of writing a file with `FileSystem.write_files`:meth:.
+
+    `size` is None for directories and if the file could not be written;
+    then `error` is the reason.
+
+    '''
+    __slots__ = ()
+
+
 class Path(object):
     '''A path data descriptor.
 
@@ -281,26 +720,63 @@ class Directory(Entry):
 
         '''
         super(Directory, self).__init__(path, fs)
-        self.registers = fs.dirs.get(self.hash).registers
+        self._entries = None
+
+    @property
+    def entries(self):
+        '''The entries of the directory (a dict from names to hashes).
+
+        Fetched when first needed.
+
+        '''
+        if self._entries is None:
+            self._entries = self.fs.get_entries(self.hash)
+        return self._entries
 
     def __contains__(self, item):
         if not isinstance(item, Entry):
             item = Entry(item, self.fs)
-        return basename(item.name) in self.children
+        return basename(item.name) in self.entries
 
     def __setitem__(self, key, value):
+        self.set(key, value)
+
+    def set(self, key, value, info=None):
+        '''Add the entry `value` under the name `key`.
+
+        If `info` (a `FileInfo`:class:) is given, store it along with the
+        entry.
+
+        '''
         if isinstance(key, Entry):
             dirname, basename = split(key.name)
             assert dirname == self.name
         else:
             basename = key
-        assert safestr(os.path.sep) not in basename
-        assert isinstance(value, Entry)
-        self.registers[basename].assign(value.hash)
-        self.registers.map.store()
+        self.update([(basename, value, info)])
+
+    def update(self, entries):
+        '''Add several entries with a single update of the directory.
+
+        `entries` is an iterable of tuples ``(name, entry, info)``, like the
+        arguments of `set`:meth:.
+
+        '''
+        from riak.datatypes import Map
+        # Assigning a register doesn't require the context of the map, so we
+        # don't need to fetch it.
+        map = Map(bucket=self.fs.dirs, key=self.hash)
+        for basename, value, info in entries:
+            assert safestr(os.path.sep) not in basename
+            assert isinstance(value, Entry)
+            map.registers[basename].assign(value.hash)
+            if info is not None:
+                info.assign(map.maps[basename])
+        map.store(return_body=False)
+        self.fs.dircache.invalidate(self.hash)
 
     def __getitem__(self, key):
-        hash = self.registers[key].value
+        hash = self.entries.get(key)
         if not hash:
             raise KeyError(key)
         return self.from_hash(hash, self.fs)
@@ -329,7 +805,500 @@ class Directory(Entry):
         '''Names of entries.
 
         '''
-        return self.registers.keys()
+        return list(self.entries)
+
+
+class DirectoryCache(object):
+    '''A cache of the entries of directories.
+
+    Keeps the entries of up to `size` directories, evicting the least
+    recently used.  Entries expire after `ttl` seconds.  If `size` is 0,
+    nothing is cached.
+
+    The file system invalidates the directories it changes, but changes done
+    by other processes are only noticed after `ttl` seconds.
+
+    Each invalidation of a directory bumps its generation.  A fetch takes
+    the `generation`:meth: before it starts, and gives it to `put`:meth:;
+    so the entries fetched before a change (in another thread) are not
+    cached after it.
+
+    '''
+    def __init__(self, size=0, ttl=5):
+        self.size = size
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        # The generations of the directories invalidated; when there are too
+        # many, they are forgotten and the epoch changes.
+        self._generations = {}
+        self._epoch = 0
+
+    def get(self, hash):
+        '''Return the cached entries of a directory or None.'''
+        if not self.size:
+            return None
+        with self._lock:
+            expires, entries = self._entries.pop(hash, (None, None))
+            if expires is not None and expires > time.time():
+                self._entries[hash] = expires, entries
+                return entries
+            else:
+                return None
+
+    def generation(self, hash):
+        '''Return the generation of the directory with the `hash`.'''
+        with self._lock:
+            return self._epoch, self._generations.get(hash, 0)
+
+    def put(self, hash, entries, generation=None):
+        '''Cache the `entries` of a directory.
+
+        If `generation` is given and the directory was invalidated since it
+        was taken, do nothing.
+
+        '''
+        if self.size:
+            with self._lock:
+                current = self._epoch, self._generations.get(hash, 0)
+                if generation is not None and generation != current:
+                    return
+                self._entries.pop(hash, None)
+                self._entries[hash] = time.time() + self.ttl, entries
+                while len(self._entries) > self.size:
+                    self._entries.popitem(last=False)
+
+    def invalidate(self, hash):
+        if self.size:
+            with self._lock:
+                self._entries.pop(hash, None)
+                self._generations[hash] = self._generations.get(hash, 0) + 1
+                if len(self._generations) > 4 * self.size:
+                    self._generations.clear()
+                    self._epoch += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._generations.clear()
+            self._epoch += 1
+
+
+class DeletionQueue(object):
+    '''Deletes the trees removed from a file system.
+
+    Each tree is deleted by a `Deletion`:class:.  The trees are deleted one
+    after the other by a background thread; the files and directories of a
+    tree are deleted by up to `workers` threads.
+
+    The status of the last `keep` deletions is kept.
+
+    '''
+    def __init__(self, fs, workers=8, keep=100):
+        self.fs = fs
+        self.workers = workers
+        self.keep = keep
+        self._lock = threading.Lock()
+        self._deletions = OrderedDict()
+        self._runner = self._pool = None
+
+    @property
+    def pool(self):
+        '''The executor that deletes files and directories.'''
+        if self._pool is None:
+            from concurrent.futures import ThreadPoolExecutor
+            with self._lock:
+                if self._pool is None:
+                    self._pool = ThreadPoolExecutor(max_workers=self.workers)
+        return self._pool
+
+    @property
+    def runner(self):
+        '''The executor that runs the deletions in the background.'''
+        if self._runner is None:
+            from concurrent.futures import ThreadPoolExecutor
+            with self._lock:
+                if self._runner is None:
+                    self._runner = ThreadPoolExecutor(max_workers=1)
+        return self._runner
+
+    def submit(self, stat, wait=False):
+        '''Delete the tree of `stat` (unlinked from its parent).
+
+        If `wait` is True, delete it in the calling thread.  Return the
+        `Deletion`:class:.
+
+        '''
+        deletion = Deletion(self, stat)
+        with self._lock:
+            self._deletions.pop(stat.name, None)
+            self._deletions[stat.name] = deletion
+            finished = [
+                name
+                for name, other in self._deletions.items()
+                if other.finished
+            ]
+            excess = len(self._deletions) - self.keep
+            if excess > 0:
+                for name in finished[:excess]:
+                    del self._deletions[name]
+        if wait:
+            deletion.run()
+        else:
+            deletion.future = self.runner.submit(deletion.run)
+        return deletion
+
+    def get(self, path):
+        '''Return the last `Deletion`:class: of `path`.
+
+        Raise `KeyError`:class: if `path` has not been deleted or it was
+        long ago.
+
+        '''
+        with self._lock:
+            return self._deletions[normalize(path)]
+
+    def status(self, path):
+        '''Return the status of the last deletion of `path`.
+
+        See `Deletion.status`:meth:.
+
+        '''
+        return self.get(path).status()
+
+    def wait(self, path):
+        '''Wait for the deletions of `path` and its ancestors to finish.'''
+        path = normalize(path)
+        with self._lock:
+            pending = [
+                deletion
+                for name, deletion in self._deletions.items()
+                if not deletion.finished and (
+                    path == name or
+                    path.startswith(name.rstrip(os.path.sep) + os.path.sep)
+                )
+            ]
+        for deletion in pending:
+            deletion.wait()
+
+    def close(self):
+        '''Wait for the pending deletions and stop the threads.'''
+        with self._lock:
+            runner, pool = self._runner, self._pool
+            self._runner = self._pool = None
+        if runner is not None:
+            runner.shutdown(wait=True)
+        if pool is not None:
+            pool.shutdown(wait=True)
+
+
+class Deletion(object):
+    '''The deletion of the tree of `stat`.
+
+    The files are deleted first (concurrently), then the maps of the
+    directories.  Each map is deleted at once, instead of removing its
+    entries one by one.  Last, the `tombstone <Tombstone>`:class: of the
+    tree is removed from its parent.
+
+    Errors don't stop the deletion; they are collected in `errors` as pairs
+    ``(name, message)``.  The blobs of files that could not be deleted are
+    left behind.
+
+    While it runs, the time in the tombstone is refreshed every `HEARTBEAT`
+    seconds.
+
+    '''
+    HEARTBEAT = 60
+
+    def __init__(self, queue, stat):
+        self.queue = queue
+        self.stat = stat
+        self.state = 'queued'
+        self.files = self.deleted = self.directories = 0
+        self.errors = []
+        self.future = None
+        self._done = threading.Event()
+
+    @property
+    def finished(self):
+        return self._done.is_set()
+
+    def status(self):
+        '''Return a dict with the progress of the deletion.
+
+        The keys are ``path``; ``state`` (one of ``'queued'``,
+        ``'running'``, ``'done'`` and ``'failed'``); ``files``, the amount
+        of files found so far; ``deleted``, the amount of files deleted;
+        ``directories``, the amount of directories deleted; and ``errors``,
+        a list of ``[name, message]``.
+
+        '''
+        return dict(
+            path=self.stat.name,
+            state=self.state,
+            files=self.files,
+            deleted=self.deleted,
+            directories=self.directories,
+            errors=[list(error) for error in self.errors],
+        )
+
+    def wait(self, timeout=None):
+        '''Wait for the deletion to finish.  Return True if it finished.'''
+        return self._done.wait(timeout)
+
+    def run(self):
+        fs = self.queue.fs
+        window = 4 * self.queue.workers
+        self.state = 'running'
+        self._touched = time.time()
+        try:
+            directories = []
+            in_flight = deque()
+            if self.stat.kind == Directory.namespace:
+                tree = fs._iterwalk(self.stat)
+            elif self.stat.kind == Tombstone.namespace:
+                # Resumed: it may have been a file or a directory.
+                tree = itertools.chain(
+                    [(None, [self.stat._replace(kind=File.namespace)])],
+                    fs._iterwalk(self.stat._replace(
+                        kind=Directory.namespace,
+                        hash=Directory(self.stat.name, fs).hash
+                    ))
+                )
+            else:
+                tree = [(None, [self.stat])]
+            for directory, entries in tree:
+                self._heartbeat()
+                if directory is not None:
+                    directories.append(directory)
+                for entry in entries:
+                    if entry.kind != Directory.namespace:
+                        self.files += 1
+                        in_flight.append(self._submit(self._delete_file,
+                                                      entry))
+                        while len(in_flight) > window:
+                            self._collect(*in_flight.popleft())
+                            self._heartbeat()
+            while in_flight:
+                self._collect(*in_flight.popleft())
+                self._heartbeat()
+            for directory in reversed(directories):
+                in_flight.append(self._submit(self._delete_map, directory))
+            while in_flight:
+                self._collect(*in_flight.popleft(), directory=True)
+                self._heartbeat()
+        except Exception as error:
+            self.errors.append((self.stat.name, str(error)))
+        try:
+            self._remove_tombstone()
+        except Exception as error:
+            self.errors.append((self.stat.name, str(error)))
+        finally:
+            self.state = 'failed' if self.errors else 'done'
+            self._done.set()
+
+    def _submit(self, fn, stat):
+        return stat, self.queue.pool.submit(fn, stat)
+
+    def _heartbeat(self):
+        # Refresh the tombstone, so that it's not taken as stale.
+        now = time.time()
+        if now - self._touched >= self.HEARTBEAT:
+            fs = self.queue.fs
+            parent = Directory(self.stat.parent, fs)
+            parent.set(basename(self.stat.name),
+                       Tombstone(self.stat.name, fs),
+                       FileInfo(0, now, ''))
+            self._touched = now
+
+    def _collect(self, stat, future, directory=False):
+        error = future.exception()
+        if error is not None:
+            self.errors.append((stat.name, str(error)))
+        elif directory:
+            self.directories += 1
+        else:
+            self.deleted += 1
+
+    def _delete_file(self, stat):
+        self.queue.fs.files.delete(stat.name)
+
+    def _delete_map(self, stat):
+        from riak import RiakObject
+        fs = self.queue.fs
+        RiakObject(fs.riak, fs.dirs, stat.hash).delete()
+        fs.dircache.invalidate(stat.hash)
+
+    def _remove_tombstone(self):
+        fs = self.queue.fs
+        parent_hash = Directory(self.stat.parent, fs).hash
+        parent = fs.get_map(parent_hash)
+        name = basename(self.stat.name)
+        tombstone = Tombstone(self.stat.name, fs).hash
+        if name in parent.registers and \
+           parent.registers[name].value == tombstone:
+            del parent.registers[name]
+            if name in parent.maps:
+                del parent.maps[name]
+            parent.store(return_body=False)
+        fs.dircache.invalidate(parent_hash)
+
+
+class BulkWrite(object):
+    '''The writing of many files, see `FileSystem.write_files`:meth:.
+
+    The names taken in each directory are tracked, so that a file is not
+    written over another one (or a directory) of the same upload before
+    the directory is updated.
+
+    '''
+    def __init__(self, fs, base, workers=8, batch_size=256):
+        self.fs = fs
+        self.base = normalize(base)
+        self.workers = workers
+        self.batch_size = batch_size
+        self.results = []
+        # The directories by path: a pair ``(directory, kinds)``, where
+        # `kinds` maps the names taken to 'file' or 'dir'; or the error
+        # that prevents writing into it.
+        self.directories = {}
+        # The files written by directory, not yet added to it: a list of
+        # ``(index, name, info)``.
+        self.batches = {}
+        self.in_flight = deque()
+
+    def run(self, files):
+        from concurrent.futures import ThreadPoolExecutor
+        try:
+            with ThreadPoolExecutor(max_workers=self.workers) as pool:
+                for path, data, content_type in files:
+                    self.add(pool, path, data, content_type)
+        finally:
+            # Even if `files` fails (e.g. a broken archive), the files
+            # already written are added to their directories.
+            while self.in_flight:
+                self.collect()
+            for parent in list(self.batches):
+                self.flush(parent)
+        return self.results
+
+    def add(self, pool, path, data, content_type):
+        index = len(self.results)
+        path = normalize(os.path.join(self.base, safestr(path).lstrip('/')))
+        self.results.append(WriteResult(path, None, None))
+        try:
+            if not path.startswith(self.base.rstrip('/') + '/'):
+                raise EnvironmentError('%s: Outside of %s' %
+                                       (path, self.base))
+            parent, name = split(path)
+            directory, kinds = self.get_directory(parent)
+            kind = kinds.get(name)
+            if data is None:
+                self.get_directory(path)
+                return
+            elif kind is not None:
+                raise EnvironmentError('Entry "%s" already exists' % path)
+            kinds[name] = File.namespace
+        except EnvironmentError as error:
+            self.results[index] = WriteResult(path, None, str(error))
+            return
+        if not content_type:
+            content_type = guess_type(path)
+        if hasattr(data, 'read'):
+            try:
+                info = self.write(path, data, content_type)
+            except Exception as error:
+                self.results[index] = WriteResult(path, None, str(error))
+            else:
+                self.written(index, info)
+        else:
+            while len(self.in_flight) >= 2 * self.workers:
+                self.collect()
+            future = pool.submit(self.write, path, data, content_type)
+            self.in_flight.append((index, future))
+
+    def get_directory(self, path):
+        '''Return the directory at `path` and the kinds of its entries.
+
+        The directory (and its ancestors) is created if needed, and taken
+        in the kinds of its parent.  Raise EnvironmentError if it can't be:
+        e.g. if the name is taken by a file, or if the parent can't be
+        created.
+
+        '''
+        res = self.directories.get(path)
+        if res is None:
+            try:
+                parent, name = split(path)
+                if name:
+                    _, kinds = self.get_directory(parent)
+                    kind = kinds.get(name)
+                    if kind not in (None, Directory.namespace):
+                        raise EnvironmentError(
+                            'File "%s" already exists' % path
+                        )
+                self.fs.mkdir(path, exist_ok=True)
+                directory = Directory(path, self.fs)
+                res = directory, {
+                    entry: hash.split('::', 1)[0]
+                    for entry, hash in self.fs.get_entries(
+                        directory.hash
+                    ).items()
+                }
+                if name:
+                    kinds[name] = Directory.namespace
+            except EnvironmentError as error:
+                res = error
+            self.directories[path] = res
+        if isinstance(res, EnvironmentError):
+            raise res
+        return res
+
+    def write(self, path, data, content_type):
+        from shutil import copyfileobj
+        from kaircs.vsbs import Blob
+        _file = File(path, self.fs)
+        # The directory was looked up: let Riak KV reject an existing blob
+        # (or let the store look it up, in write once buckets).
+        with self.fs.files.open(_file.name, 'w', if_none_match=True) as target:
+            if hasattr(data, 'read'):
+                copyfileobj(data, target, 4 * Blob.CHUNK_SIZE)
+            else:
+                target.write(data)
+        return FileInfo(target.written, time.time(), content_type)
+
+    def collect(self):
+        index, future = self.in_flight.popleft()
+        try:
+            info = future.result()
+        except Exception as error:
+            path = self.results[index].path
+            self.results[index] = WriteResult(path, None, str(error))
+        else:
+            self.written(index, info)
+
+    def written(self, index, info):
+        path = self.results[index].path
+        self.results[index] = WriteResult(path, info.size, None)
+        parent, name = split(path)
+        batch = self.batches.setdefault(parent, [])
+        batch.append((index, name, info))
+        if len(batch) >= self.batch_size:
+            self.flush(parent)
+
+    def flush(self, parent):
+        '''Add the files written in `parent` to it.'''
+        batch = self.batches.pop(parent)
+        directory, _ = self.directories[parent]
+        try:
+            directory.update(
+                (name, File(os.path.join(parent, name), self.fs), info)
+                for _, name, info in batch
+            )
+        except Exception as error:
+            for index, _, _ in batch:
+                path = self.results[index].path
+                self.results[index] = WriteResult(path, None, str(error))
 
 
 class Link(Entry):
@@ -341,6 +1310,32 @@ class File(Entry):
     namespace = 'file'
 
 
+class Tombstone(Entry):
+    '''An entry being deleted, see `FileSystem.rm`:meth:.
+
+    The tombstone takes the place of the entry in its directory until the
+    deletion ends, so that no process creates the entry (or anything under
+    it) again while its files and maps are being deleted.  Then the new
+    ones would be deleted too.
+
+    The tombstone has the time of the last heartbeat of its deletion (see
+    `Deletion`:class:).  If it's older than `TIMEOUT` seconds, the tombstone
+    is stale: the deletion was interrupted (e.g. the process was killed).
+    Then `FileSystem.rm`:meth: resumes the deletion, and the garbage
+    collector takes the blobs under it as garbage.
+
+    '''
+    namespace = 'deleted'
+
+    #: The seconds after which a tombstone without heartbeat is stale.
+    TIMEOUT = 600
+
+    @classmethod
+    def is_stale(cls, stat):
+        '''Test if the tombstone with the `Stat`:class: `stat` is stale.'''
+        return (stat.mtime or 0) < time.time() - cls.TIMEOUT
+
+
 def dirname(path):
     '''Return the dirname of `path` after `normalization <normalize>`:func:.
 
@@ -356,12 +1351,28 @@ def basename(path):
     return os.path.basename(normalize(path))
 
 
+def guess_type(path):
+    '''Return the content type of `path` guessed from its name.'''
+    from mimetypes import guess_type
+    return guess_type(path)[0] or 'application/octet-stream'
+
+
+@lru_cache(maxsize=4096)
 def normalize(path):
     '''Normalize a `path` to the canonical form.
 
     - Removes trailing slashes.
     - Remove duplicated consecutive slashes (even at the beginning).
+    - Resolves ``.`` and ``..`` components.
+
+    This is done on the string alone: the local file system is not looked
+    up (paths are in the name space of KairCS, not the one of the host).
+    The results for the last 4096 paths are kept.
 
     '''
-    from os.path import realpath, normpath
-    return safestr(realpath(normpath(path)))
+    res = os.path.normpath(safestr(path))
+    if res.startswith('//'):
+        # normpath keeps two leading slashes, as POSIX allows for them to
+        # mean something else.
+        res = '/' + res.lstrip('/')
+    return res
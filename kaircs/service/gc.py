@@ -0,0 +1,324 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# ---------------------------------------------------------------------
+# Copyright (c) Merchise Autrement [~º/~] and Contributors
+# All rights reserved.
+#
+# This is free software; you can do what the LICENCE file allows you to.
+#
+
+'''The garbage collector of a KairCS file system.
+
+Blobs are left behind when a writer dies (a dirty first chunk and some of
+the other chunks) or when the deletion of a file fails after it was removed
+from its directory.  The collector lists the keys of the bucket of the
+blobs, groups them by the master key of their blob, and deletes the groups
+of the blobs no directory refers to.
+
+Listing the keys of a bucket traverses all the keys of the cluster.  With
+``listing='index'`` the keys are listed with the ``$bucket`` index instead
+(this requires a backend with secondary indexes, e.g. LevelDB); the keys
+come sorted, so they are grouped without holding the keys of the whole
+bucket in memory.
+
+The collector issues at most `rate` requests per second to Riak KV (for the
+directories, the keys and the blobs), from up to `workers` threads, so that
+it doesn't hurt the latency of the service.
+Blobs whose first chunk was written in the last `grace` seconds are left
+alone: they may be being written, or not linked to their directory yet.
+Without a first chunk, a blob is left alone if any of its chunks is that
+recent.
+
+The chunks of deduplicated blobs (``sha256/...``) are not collected; they
+are deleted when their reference count drops to zero.  The references taken
+by a deduplicated blob which was never completed are not released.
+
+Usage::
+
+  $ kaircs-gc [-c CONFIG] [--rate N] [--workers N] [--grace SECONDS]
+              [--index] [--dry-run]
+
+'''
+
+from __future__ import (division as _py3_division,
+                        print_function as _py3_print,
+                        absolute_import as _py3_abs_import)
+
+import time
+import threading
+from collections import deque
+from contextlib import closing
+
+
+class RateLimiter(object):
+    '''Let at most `rate` requests per second go through.
+
+    If `rate` is 0, there's no limit.
+
+    '''
+    def __init__(self, rate):
+        self.rate = rate
+        self._lock = threading.Lock()
+        self._next = time.time()
+
+    def wait(self, requests=1):
+        '''Wait until `requests` more requests can go through.'''
+        if not self.rate:
+            return
+        with self._lock:
+            now = time.time()
+            start = max(now, self._next)
+            self._next = start + requests / self.rate
+        if start > now:
+            time.sleep(start - now)
+
+
+class GarbageCollector(object):
+    '''Collect the blobs of `fs` that no directory refers to.
+
+    :param rate: The maximum number of requests per second to Riak KV.  If
+                 0, there's no limit.
+
+    :param workers: The number of blobs checked and deleted at the same
+                    time.
+
+    :param grace: The blobs whose first chunk was written less than these
+                  seconds ago are kept.
+
+    :param listing: How to list the keys of the bucket: ``'keys'`` (list
+                    keys) or ``'index'`` (the ``$bucket`` index).
+
+    :param dry_run: If True, find the garbage but don't delete it.
+
+    '''
+    def __init__(self, fs, rate=50, workers=4, grace=86400, listing='keys',
+                 dry_run=False):
+        if listing not in ('keys', 'index'):
+            raise ValueError('Unknown listing "%s"' % listing)
+        self.fs = fs
+        self.store = fs.files
+        self.limiter = RateLimiter(rate)
+        self.workers = workers
+        self.grace = grace
+        self.listing = listing
+        self.dry_run = dry_run
+        self._lock = threading.Lock()
+        self.stats = dict(blobs=0, live=0, recent=0, collected=0, keys=0,
+                          errors=0)
+
+    def collect(self):
+        '''Collect the garbage.  Return the `stats`.
+
+        `stats` is a dict with the amount of ``blobs`` found, those which
+        are ``live`` (in a directory) or ``recent`` (in the grace period),
+        those ``collected``, the ``keys`` deleted (or that would be deleted
+        in a dry run) and the ``errors``.
+
+        '''
+        from concurrent.futures import ThreadPoolExecutor
+        # Take the live blobs before listing the keys: the blobs written
+        # after this point are recent.
+        live = self.get_live_blobs()
+        in_flight = deque()
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            for master_key, keys in self.iter_blobs():
+                self.stats['blobs'] += 1
+                if master_key in live:
+                    self.stats['live'] += 1
+                    continue
+                while len(in_flight) >= 2 * self.workers:
+                    self._collect_result(in_flight.popleft())
+                in_flight.append(pool.submit(self.collect_blob, master_key,
+                                             keys))
+            while in_flight:
+                self._collect_result(in_flight.popleft())
+        return self.stats
+
+    def _collect_result(self, future):
+        try:
+            future.result()
+        except Exception:
+            self._count('errors')
+
+    def _count(self, name, amount=1):
+        with self._lock:
+            self.stats[name] += amount
+
+    def get_live_blobs(self):
+        '''Return the set of the master keys of the files in directories.
+
+        The files of the trees being deleted are taken as live: their
+        deletion releases them.  Unless the deletion was interrupted (its
+        tombstone is stale).
+
+        The tree is walked breadth-first, fetching up to `workers`
+        directories at the same time.
+
+        '''
+        from concurrent.futures import ThreadPoolExecutor
+        from .fs import Entry, Stat, Directory, File, Tombstone
+        live = set()
+        pending, in_flight = deque([self.fs.root]), deque()
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            while pending or in_flight:
+                while pending and len(in_flight) < self.workers:
+                    in_flight.append(pool.submit(self.get_listing,
+                                                 pending.popleft()))
+                entries, info = in_flight.popleft().result()
+                for name, hash in entries.items():
+                    entry = Entry.from_hash(hash, self.fs)
+                    if entry.namespace == Directory.namespace:
+                        pending.append(entry)
+                    elif entry.namespace == File.namespace:
+                        blob = self.store.get_blob(entry.name)
+                        live.add(blob.master_key)
+                    elif entry.namespace == Tombstone.namespace:
+                        stat = Stat.from_hash(hash, None, info.get(name))
+                        if Tombstone.is_stale(stat):
+                            continue
+                        # Being deleted, maybe a file or a directory: leave
+                        # it to its deletion.
+                        pending.append(Directory(entry.name, self.fs))
+                        blob = self.store.get_blob(entry.name)
+                        live.add(blob.master_key)
+        return live
+
+    def get_listing(self, directory):
+        self.limiter.wait()
+        return self.fs.get_listing(directory.hash)
+
+    def iter_blobs(self):
+        '''Yield ``(master_key, keys)`` for the blobs in the bucket.
+
+        `keys` are the keys of the chunks found for the blob.
+
+        '''
+        blobs = {}
+        last = None
+        for key in self.iter_keys():
+            master_key, sep, index = key.rpartition('/')
+            if not sep or master_key == 'sha256':
+                continue  # not a chunk, or a deduplicated chunk
+            if self.listing == 'index' and master_key != last:
+                # Keys come sorted: the previous blob is complete.
+                if last is not None:
+                    yield last, blobs.pop(last)
+                last = master_key
+            blobs.setdefault(master_key, []).append(key)
+        for item in blobs.items():
+            yield item
+
+    def iter_keys(self):
+        bucket = self.store.bucket
+        if self.listing == 'index':
+            self.limiter.wait()
+            for page in bucket.paginate_stream_index('$bucket', bucket.name):
+                with closing(page):
+                    for key in page:
+                        yield key
+                self.limiter.wait()
+        else:
+            import riak
+            # Riak's client refuses to list keys unless told otherwise.
+            previous = riak.disable_list_exceptions
+            riak.disable_list_exceptions = True
+            try:
+                self.limiter.wait()
+                with closing(bucket.stream_keys()) as stream:
+                    for keys in stream:
+                        for key in keys:
+                            yield key
+            finally:
+                riak.disable_list_exceptions = previous
+
+    def collect_blob(self, master_key, keys):
+        '''Delete the chunks (`keys`) of the blob with the `master_key`.
+
+        Unless the first chunk (or, if it's missing, any other chunk) is
+        recent.  The first chunk is always fetched: the listing of the keys
+        is not a snapshot, and it may have been written after the listing
+        went past it.  The references of a complete deduplicated blob are
+        released.
+
+        '''
+        from riak import RiakObject
+        from kaircs.vsbs import BlobMetadata
+        first_key = '%s/0' % master_key
+        self.limiter.wait()
+        first = RiakObject(self.store.riak, self.store.bucket, first_key)
+        first.reload(r=1)
+        if first.exists:
+            if self._is_recent(first):
+                self._count('recent')
+                return
+            metadata = BlobMetadata()
+            metadata.extract(first.encoded_data)
+            keys = [first_key] + [key for key in keys if key != first_key]
+        else:
+            # The rest of a failed deletion, or of one in progress.
+            metadata = None
+            keys = [key for key in keys if key != first_key]
+            for key in keys:
+                self.limiter.wait()
+                chunk = RiakObject(self.store.riak, self.store.bucket, key)
+                chunk.reload(r=1, head_only=True)
+                if chunk.exists and self._is_recent(chunk):
+                    self._count('recent')
+                    return
+        self._count('collected')
+        self._count('keys', len(keys))
+        if self.dry_run:
+            return
+        if metadata is not None and not metadata.dirty and metadata.manifest:
+            for digest in metadata.manifest:
+                self.store.release_content(digest,
+                                           throttle=self.limiter.wait)
+        # The first chunk goes first: a blob without it is not readable, and
+        # the rest is found again if we fail.
+        for key in keys:
+            self.limiter.wait()
+            RiakObject(self.store.riak, self.store.bucket, key).delete()
+
+    def _is_recent(self, robj):
+        modified = robj.last_modified or 0
+        return modified > time.time() - self.grace
+
+
+def main(argv=None):
+    import json
+    import argparse
+    from .config import load_config, create_filesystem
+    parser = argparse.ArgumentParser(
+        prog='kaircs-gc',
+        description='Delete the blobs that no directory refers to.'
+    )
+    parser.add_argument('-c', '--config', default=None,
+                        help='The configuration file.  Defaults to the '
+                        'environment variable KAIRCS_CONFIG.')
+    parser.add_argument('--rate', type=float, default=50,
+                        help='The maximum number of requests per second '
+                        '(0 for no limit).  Default: 50.')
+    parser.add_argument('--workers', type=int, default=4,
+                        help='The number of blobs collected at the same '
+                        'time.  Default: 4.')
+    parser.add_argument('--grace', type=float, default=86400,
+                        help='Keep the blobs written less than these '
+                        'seconds ago.  Default: 86400 (a day).')
+    parser.add_argument('--index', action='store_const', const='index',
+                        dest='listing', default='keys',
+                        help='List the keys with the $bucket index.')
+    parser.add_argument('--dry-run', action='store_true',
+                        help="Find the garbage but don't delete it.")
+    args = parser.parse_args(argv)
+    fs = create_filesystem(load_config(args.config))
+    try:
+        collector = GarbageCollector(fs, rate=args.rate, workers=args.workers,
+                                     grace=args.grace, listing=args.listing,
+                                     dry_run=args.dry_run)
+        print(json.dumps(collector.collect(), sort_keys=True))
+    finally:
+        fs.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -14,21 +14,24 @@ from __future__ import (division as _py3_division,
                         print_function as _py3_print,
                         absolute_import as _py3_abs_import)
 
+import zlib
 import operator
 from functools import partial
 from flask import Flask, request
 
-from werkzeug.wrappers import Response
-from werkzeug.exceptions import NotFound, BadRequest
+from werkzeug.wrappers import Request, Response
+from werkzeug.datastructures import ContentRange
+from werkzeug.exceptions import NotFound, BadRequest, UnsupportedMediaType
 
 from xoutil.eight.string import force as safestr
 from xoutil.fp.tools import compose
 
-from .fs import FileSystem, basename, dirname
+from .fs import basename, dirname
 from xoutil.objects import delegator
 
 
-DELEGATED_METHOD_NAMES = ('exists', 'isdir', 'open', 'mkdir', 'ls', 'rm')
+DELEGATED_METHOD_NAMES = ('exists', 'isdir', 'open', 'mkdir', 'ls', 'rm',
+                          'stat', 'scandir')
 DELEGATED_METHODS_MAP = {k: k for k in DELEGATED_METHOD_NAMES}
 
 
@@ -46,15 +49,22 @@ class KairCSApplication(Flask, delegator('fs', DELEGATED_METHODS_MAP)):
         self.add_url_rule('/<path:path>', 'get', __(self.GET), methods=['GET'])
         self.add_url_rule('/<path:path>', 'put', __(self.PUT), methods=['PUT'])
         self.add_url_rule('/<path:path>', 'del', __(self.DELETE), methods=['DELETE'])
+        self.add_url_rule('/', 'root-post', __(self.POST), methods=['POST'])
+        self.add_url_rule('/<path:path>', 'post', __(self.POST),
+                          methods=['POST'])
         self.fs = fs
 
     def GET(self, path=''):
-        if not self.exists(path):
+        if 'deletion' in request.args:
+            return self.deletion_status(path)
+        try:
+            stat = self.stat(path)
+        except EnvironmentError:
             raise NotFound
-        if self.isdir(path):
-            return DirectoryStream(self, path)
+        if stat.kind == 'dir':
+            return DirectoryStream(self, path, stat)
         else:
-            return FileStream(self, path)
+            return FileStream(self, path, stat)
 
     def PUT(self, path):
         from shutil import copyfileobj
@@ -63,28 +73,187 @@ class KairCSApplication(Flask, delegator('fs', DELEGATED_METHODS_MAP)):
         if self.exists(path) and self.isdir(path):
             raise BadRequest
         self.mkdir(dir, exist_ok=True)
-        with self.open(path, 'w') as target:
+        content_type = get_upload_content_type(request)
+        with self.open(path, 'w', content_type=content_type) as target:
             copyfileobj(request.stream, target, 4 * Blob.CHUNK_SIZE)
         return Response(
             status=201
         )
 
+    def POST(self, path):
+        '''Upload many files under the directory `path` (a bulk upload).
+
+        The body is a tar archive or ``multipart/form-data``, see
+        `get_bulk_files`:func:.  The files are written concurrently with
+        `~kaircs.service.fs.FileSystem.write_files`:meth:, and the reply is
+        the JSON manifest of `get_bulk_response`:func:.
+
+        '''
+        results = self.fs.write_files(path, get_bulk_files(request))
+        return get_bulk_response(path, results)
+
     def DELETE(self, path):
         '''Perform the DELETE of `path`.
 
         .. warning:: You should not reimplement this method to do an off-load
            of the deletion, instead override `rm`.
 
-        We always return '202 Accepted', even though the standard
-        implementation of `rm` actually deletes before we can return the
-        response; but the idea is to allow for simple overrides that does not
-        deal with HTTP status codes.
+        We return '202 Accepted' as soon as `path` is removed from its
+        directory; its files are deleted in the background.  The
+        ``Location`` header points to the status of the deletion (see
+        `deletion_status`:meth:).  An interrupted deletion of `path` is
+        resumed.
 
         '''
-        if not self.exists(path):
+        if not self.exists(path) and not is_interrupted(self.fs, path):
             raise NotFound
-        self.rm(path, recursive=True)
-        return Response(status=202)  # Accepted
+        self.rm(path, recursive=True, wait=False)
+        return get_deletion_response(path)
+
+    def deletion_status(self, path):
+        '''Return the status of the deletion of `path` as JSON.
+
+        See `kaircs.service.fs.FileSystem.deletion_status`:meth:.
+
+        '''
+        return get_deletion_status_response(self.fs, path)
+
+
+def get_upload_content_type(request):
+    '''Return the content type of the file uploaded by `request`.
+
+    Return None if it should be guessed from the path.
+
+    '''
+    # Clients like curl send form-encoded as the default content type; for
+    # those we'd better guess it from the path.
+    if request.mimetype == 'application/x-www-form-urlencoded':
+        return None
+    else:
+        return request.content_type
+
+
+#: The content types of tar archives accepted by bulk uploads.  The
+#: compression (gzip, bzip2 or xz) is detected from the archive itself.
+TAR_TYPES = ('application/x-tar', 'application/x-gtar', 'application/gzip',
+             'application/x-gzip', 'application/x-bzip2', 'application/x-xz')
+
+
+def get_bulk_files(request):
+    '''Return the files uploaded in bulk by `request`.
+
+    The body of the request is either a tar archive (see `TAR_TYPES`:data:),
+    read as a stream; or ``multipart/form-data`` where the file name of each
+    part is its path.  Directories of the archive are created; links and
+    other special entries are skipped.
+
+    Return an iterator of ``(path, data, content_type)`` as expected by
+    `~kaircs.service.fs.FileSystem.write_files`:meth:.  Files up to
+    `~kaircs.vsbs.Blob.CHUNK_SIZE`:data: are read in memory, so that they
+    are written concurrently.  Raise `UnsupportedMediaType` for other
+    bodies; and `BadRequest` (while iterating) for broken archives.
+
+    '''
+    if request.mimetype == 'multipart/form-data':
+        return _get_form_files(request.files)
+    elif request.mimetype in TAR_TYPES:
+        return _get_tar_files(request.stream)
+    else:
+        raise UnsupportedMediaType
+
+
+def _get_form_files(files):
+    from ..vsbs import Blob
+    for field, storage in files.items(multi=True):
+        stream = storage.stream
+        stream.seek(0, 2)
+        if stream.tell() <= Blob.CHUNK_SIZE:
+            stream.seek(0)
+            data = stream.read()
+        else:
+            stream.seek(0)
+            data = stream
+        yield storage.filename or field, data, storage.mimetype or None
+
+
+def _get_tar_files(stream):
+    import tarfile
+    from ..vsbs import Blob
+    try:
+        with tarfile.open(fileobj=stream, mode='r|*') as archive:
+            for member in archive:
+                if member.isdir():
+                    yield member.name, None, None
+                elif member.isfile():
+                    data = archive.extractfile(member)
+                    if member.size <= Blob.CHUNK_SIZE:
+                        data = data.read()
+                    yield member.name, data, None
+    except (tarfile.TarError, EOFError, zlib.error) as error:
+        raise BadRequest('Broken archive: %s' % error)
+
+
+def get_bulk_response(path, results):
+    '''Return the response to the bulk upload into `path`.
+
+    The body is a JSON object with the keys ``path``, ``files`` (a list of
+    objects with the keys ``path``, ``size`` and ``error``; one for each
+    entry uploaded, in the same order) and ``errors`` (the amount of
+    entries that failed).
+
+    '''
+    import json
+    files = [result._asdict() for result in results]
+    errors = sum(1 for result in results if result.error)
+    body = dict(path=path, files=files, errors=errors)
+    return Response(json.dumps(body), mimetype='application/json')
+
+
+def get_archive_response(fs, path, format):
+    '''Return an archive of the tree of the directory `path` in `fs`.
+
+    The `format` is one of `kaircs.service.archive.FORMATS`:data:.  The
+    archive is streamed while the tree is walked, and the files ahead of the
+    one being sent are fetched concurrently (see
+    `~kaircs.service.fs.FileSystem.export_tree`:meth:).
+
+    '''
+    from .archive import FORMATS
+    try:
+        archiver, mimetype = FORMATS[format]
+    except KeyError:
+        raise BadRequest('Unknown archive format "%s"' % format)
+    tree = fs.export_tree(path)
+    response = Response(archiver(tree, path), mimetype=mimetype)
+    filename = '%s.%s' % (basename(path) or 'root', format)
+    response.headers['Content-Disposition'] = 'attachment; filename="%s"' % (
+        filename
+    )
+    response.call_on_close(tree.close)
+    return response
+
+
+def get_deletion_response(path):
+    '''Return the response to the DELETE of `path`.'''
+    response = Response(status=202)  # Accepted
+    response.headers['Location'] = '%s?deletion' % path
+    return response
+
+
+def is_interrupted(fs, path):
+    '''Test if the deletion of `path` in `fs` was interrupted.'''
+    return fs.deletion_status(path)['state'] == 'interrupted'
+
+
+def get_deletion_status_response(fs, path):
+    '''Return the status of the deletion of `path` in `fs` as JSON.
+
+    See `kaircs.service.fs.FileSystem.deletion_status`:meth:.
+
+    '''
+    import json
+    status = fs.deletion_status(path)
+    return Response(json.dumps(status), mimetype='application/json')
 
 
 class Resource(object):
@@ -111,45 +280,307 @@ class Resource(object):
 class FileStream(Resource):
     '''Response object used to stream files
 
+    Supports HEAD requests, conditional requests (``If-None-Match``) and
+    single byte ranges (``Range`` and ``If-Range``).  Only the chunks
+    covering the requested range are fetched.
+
+    The entity tag is derived from the master key of the blob, its size and
+    its version (see `get_etag`:meth:).  If the `stat` of the file has its
+    size (and content type), HEAD requests and successful revalidations are
+    answered without fetching the blob.
+
+    Blobs compressed with the ``gzip`` codec are sent as stored (with
+    ``Content-Encoding: gzip``) to clients which accept it, unless they ask
+    for a range.  The chunks are not decompressed.  Since the codec is in
+    the first chunk, a HEAD request of such a client always fetches it.
+
     '''
-    @property
-    def contents(self):
-        with self.app.open(self.path, 'r') as f:
-            res = f.read(4096)
-            while res:
-                yield res
-                res = f.read(4096)
+    def __init__(self, app, path, stat=None):
+        super(FileStream, self).__init__(app, path)
+        self.stat = stat
+
+    def __call__(self, environ, start_response):
+        response = self.respond(Request(environ))
+        return response(environ, start_response)
+
+    def respond(self, request):
+        '''Return the response to `request`.
+
+        The body of the response reads the blob; the reader is closed when
+        the response is closed.
+
+        '''
+        stat = self.stat
+        content_type = stat.content_type if stat is not None else None
+        if stat is not None and stat.size is not None:
+            blob = self.app.fs.files.get_blob(stat.name)
+            if stat.size and self.accepts_encoding(request):
+                # Whether the blob is sent compressed is not known until
+                # it's fetched; only a tag of the compressed blob tells.
+                etag = self.get_etag(blob, stat.size, 'gzip')
+                if (request.method != 'HEAD' and
+                        request.if_none_match.contains_weak(etag)):
+                    return self.get_not_modified(etag, 'gzip')
+            else:
+                etag = self.get_etag(blob, stat.size)
+                if (request.method == 'HEAD' or
+                        request.if_none_match.contains_weak(etag)):
+                    return self.get_response(request, blob, stat.size,
+                                             content_type=content_type)
+        reader = self.app.open(self.path, 'r')
+        try:
+            blob = reader.blob
+            response = self.get_response(request, blob, blob.metadata.size,
+                                         reader, content_type)
+        except:  # noqa: E722
+            reader.close()
+            raise
+        response.call_on_close(reader.close)
+        return response
+
+    def get_etag(self, blob, size, encoding=None):
+        '''Return the entity tag of the blob.
+
+        A file deleted and written again with the same size gets another
+        tag: the version is the time the file was written (as recorded in
+        its directory) or, if unknown, the `stamp
+        <kaircs.vsbs.BlobMetadata.stamp>`:attr: of the blob.
+
+        '''
+        stat = self.stat
+        if stat is not None and stat.mtime is not None:
+            version = '%x' % int(round(stat.mtime * 1000))
+        elif blob.metadata.stamp is not None:
+            version = '%08x' % (zlib.crc32(
+                safestr(blob.metadata.stamp).encode('utf-8')
+            ) & 0xffffffff)
+        else:
+            version = None
+        etag = '%s-%x' % (blob.master_key, size)
+        if version is not None:
+            etag += '-' + version
+        if encoding is not None:
+            etag += '-' + encoding
+        return etag
+
+    def get_encoding(self, request, blob, size, reader=None):
+        '''Return the content coding in which the blob is sent as stored.
+
+        Return None if the blob must be decompressed: it's not compressed
+        with gzip, the client doesn't accept gzip, or it asks for a range.
+
+        '''
+        codec = blob.metadata.codec
+        if (reader is not None and size and codec is not None and
+                codec.name == 'gzip' and self.accepts_encoding(request)):
+            return 'gzip'
+        else:
+            return None
+
+    @staticmethod
+    def accepts_encoding(request):
+        '''Whether a blob compressed with gzip is sent as stored.'''
+        return request.range is None and bool(request.accept_encodings['gzip'])
+
+    @staticmethod
+    def get_not_modified(etag, encoding=None):
+        '''Return the response to a successful revalidation.'''
+        response = Response(status=304)
+        response.set_etag(etag)
+        if encoding is not None:
+            response.vary.add('Accept-Encoding')
+        return response
+
+    def get_response(self, request, blob, size, reader=None,
+                     content_type=None):
+        '''Return the response to `request`.
+
+        If `reader` is None, the response has no body.
+
+        '''
+        encoding = self.get_encoding(request, blob, size, reader)
+        etag = self.get_etag(blob, size, encoding)
+        if request.if_none_match.contains_weak(etag):
+            return self.get_not_modified(etag, encoding)
+        if encoding is not None:
+            response = Response(reader.iter_encoded(),
+                                content_type=content_type or
+                                'application/octet-stream')
+            response.content_encoding = encoding
+            response.vary.add('Accept-Encoding')
+            response.set_etag(etag)
+            return response
+        status, start, stop = 200, 0, size
+        byterange = self.get_range(request, etag)
+        if byterange is not None:
+            bounds = byterange.range_for_length(size)
+            if bounds is not None:
+                status, (start, stop) = 206, bounds
+            elif len(byterange.ranges) == 1:
+                response = Response(status=416)
+                response.headers['Content-Range'] = 'bytes */%d' % size
+                return response
+            # else: We don't support multiple ranges, send everything.
+        if reader is not None:
+            if start:
+                reader.seek(start)
+            # Werkzeug won't iterate the contents for HEAD requests.
+            contents = self.contents(reader, stop - start)
+        else:
+            contents = ()
+        response = Response(contents, status=status,
+                            content_type=content_type or
+                            'application/octet-stream')
+        response.headers['Accept-Ranges'] = 'bytes'
+        response.content_length = stop - start
+        if status == 206:
+            response.content_range = ContentRange('bytes', start, stop, size)
+        response.set_etag(etag)
+        return response
+
+    def get_range(self, request, etag):
+        '''Return the range requested if it applies to the file.
+
+        If ``If-Range`` is given and does not match our entity tag, the
+        request range does not apply.  We don't send ``Last-Modified``, so
+        ``If-Range`` with a date never matches.
+
+        '''
+        if_range = request.if_range
+        if if_range.date is not None or if_range.etag not in (None, etag):
+            return None
+        else:
+            return request.range
+
+    def contents(self, reader, length):
+        '''Yield `length` bytes from `reader`.
+
+        Each piece goes up to the end of a chunk of the blob, so that the
+        reader returns it with a single copy and the server writes about
+        `~kaircs.vsbs.Blob.CHUNK_SIZE`:data: bytes at a time.
+
+        '''
+        from ..vsbs import Blob
+        while length > 0:
+            available = Blob.CHUNK_SIZE - reader.tell() % Blob.CHUNK_SIZE
+            res = reader.read(min(available, length))
+            if not res:
+                break
+            yield res
+            length -= len(res)
 
 
 class DirectoryStream(Resource):
     '''Response object used to stream directory contents
 
+    The listing is built from the map of the directory alone (each entry
+    tells whether it's a directory or a file).  The HTML is sent a line at a
+    time.
+
+    With ``?format=json`` reply with a page of entries::
+
+      {"path": "/a", "entries": [{"name": "b", "kind": "dir"},
+                                 {"name": "c.txt", "kind": "file",
+                                  "size": 3, "mtime": 1539000000.0,
+                                  "content_type": "text/plain"}, ...],
+       "next": "c.txt"}
+
+    Entries are sorted by name.  A page has up to ``limit`` entries (default
+    `page_size`:attr:, no more than `max_page_size`:attr:).  If there are
+    more entries, ``next`` is the cursor to pass as ``cursor`` to get the
+    next page; otherwise it's null.
+
+    With ``?archive=tar`` (or ``zip``) reply with an archive of the whole
+    tree of the directory, see `get_archive_response`:func:.
+
     '''
     link_tpl = '<a href="./%s">%s</a><br/>'
+    page_size = 1000
+    max_page_size = 10000
 
-    @property
-    def headers(self):
-        return {'mimetype': 'text/html'}
+    def __init__(self, app, path, stat=None):
+        super(DirectoryStream, self).__init__(app, path)
+        self.stat = stat
 
-    @property
-    def contents(self):
-        response = ''
-        for i in self.app.ls(self.path):
-            if i == self.path:
-                response += '<a href="..">..</a><br/>'
-            else:
-                name = basename(i)
-                if self.app.isdir(i):
-                    name += '/'
-                response += self.link_tpl % (name, name)
-        return response
+    def __call__(self, environ, start_response):
+        try:
+            response = self.respond(Request(environ))
+        except BadRequest as error:
+            # We're called after the view returned, so Flask won't handle the
+            # error for us.
+            response = error
+        return response(environ, start_response)
+
+    def respond(self, request):
+        '''Return the response to `request`.'''
+        archive = request.args.get('archive')
+        if archive:
+            return get_archive_response(self.app.fs, self.path, archive)
+        entries = self.app.scandir(self.stat or self.path)
+        if request.args.get('format') == 'json':
+            return self.get_page(request, entries)
+        else:
+            return Response(self.get_html(entries), mimetype='text/html')
+
+    def get_html(self, entries):
+        yield '<a href="..">..</a><br/>'
+        for entry in entries:
+            name = basename(entry.name)
+            if entry.kind == 'dir':
+                name += '/'
+            yield self.link_tpl % (name, name)
+
+    def get_page(self, request, entries):
+        import json
+        from bisect import bisect_right
+        try:
+            limit = int(request.args.get('limit', self.page_size))
+        except ValueError:
+            raise BadRequest('Invalid limit')
+        if not 0 < limit <= self.max_page_size:
+            raise BadRequest('Invalid limit')
+        names = [basename(entry.name) for entry in entries]
+        cursor = request.args.get('cursor')
+        start = bisect_right(names, cursor) if cursor is not None else 0
+        stop = start + limit
+        page = dict(
+            path=self.path,
+            entries=[
+                self.describe(name, entry)
+                for name, entry in zip(names[start:stop], entries[start:stop])
+            ],
+            next=names[stop - 1] if stop < len(names) else None,
+        )
+        return Response(json.dumps(page), mimetype='application/json')
+
+    @staticmethod
+    def describe(name, entry):
+        '''Return the JSON description of an entry.
+
+        Files also have the keys ``size``, ``mtime`` and ``content_type``, if
+        they are known.
+
+        '''
+        res = dict(name=name, kind=entry.kind)
+        if entry.size is not None:
+            res.update(size=entry.size, mtime=entry.mtime,
+                       content_type=entry.content_type)
+        return res
 
 
 def main():
-    fs = FileSystem([{'host': '127.0.0.1', 'http_port': 8098}],
-                    'store', dir_bucket_type='maps')
-    app = KairCSApplication(fs)
-    app.run(host="0.0.0.0")
+    '''Run the service in the development server of Flask.
+
+    The configuration is taken from the environment (see
+    `kaircs.service.config`:mod:).  Use `kaircs.service.server`:mod: in
+    production.
+
+    '''
+    from .config import load_config, create_filesystem
+    config = load_config()
+    app = KairCSApplication(create_filesystem(config))
+    host, _, port = config['bind'].rpartition(':')
+    app.run(host=host, port=int(port), debug=config['debug'])
 
 
 if __name__ == '__main__':
@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# ---------------------------------------------------------------------
+# Copyright (c) Merchise Autrement [~º/~] and Contributors
+# All rights reserved.
+#
+# This is free software; you can do what the LICENCE file allows you to.
+#
+
+'''The production server of KairCS.
+
+The server is a `gunicorn <https://gunicorn.org/>`_ master process (``pip
+install kaircs[server]``) that forks `workers` processes sharing the
+listening socket.  Each worker creates its own
+`~kaircs.service.fs.FileSystem`:class: (and thus the Riak KV client and its
+connection pools, and the thread pools) after it's forked.
+
+- ``SIGHUP`` reloads the configuration and replaces the workers gracefully:
+  new workers are started, and the old ones finish their requests before
+  exiting.
+
+- ``SIGTERM`` stops the server gracefully (waiting up to
+  `graceful_timeout` seconds for the requests in progress).
+
+- A worker is replaced after it serves `max_requests` requests (plus a
+  random amount up to `max_requests_jitter`).
+
+The configuration comes from a file or the environment, see
+`kaircs.service.config`:mod:.  With ``app = asgi`` the workers run the
+`ASGI application <kaircs.service.asgi>`:mod: on uvicorn.
+
+Usage::
+
+  $ kaircs [-c CONFIG]
+
+'''
+
+from __future__ import (division as _py3_division,
+                        print_function as _py3_print,
+                        absolute_import as _py3_abs_import)
+
+import argparse
+
+from gunicorn.app.base import BaseApplication
+
+from .config import load_config, create_filesystem
+
+
+class KairCSServer(BaseApplication):
+    '''A pre-fork server of the KairCS service.
+
+    The configuration is read again when the server is reloaded.
+
+    '''
+    def __init__(self, filename=None):
+        self.filename = filename
+        self.config = None
+        super(KairCSServer, self).__init__(prog='kaircs')
+
+    def load_config(self):
+        self.config = config = load_config(self.filename)
+        settings = {
+            'bind': config['bind'],
+            'workers': config['workers'],
+            'max_requests': config['max_requests'],
+            'max_requests_jitter': config['max_requests_jitter'],
+            'timeout': config['timeout'],
+            'graceful_timeout': config['graceful_timeout'],
+            'loglevel': 'debug' if config['debug'] else 'info',
+            # The file system must be created in each worker, after the
+            # fork; the pools of connections and threads can't be shared.
+            'preload_app': False,
+        }
+        if config['app'] == 'asgi':
+            settings['worker_class'] = 'uvicorn.workers.UvicornWorker'
+        elif config['app'] == 'wsgi':
+            settings['worker_class'] = 'gthread'
+            settings['threads'] = config['threads']
+        else:
+            raise ValueError('Unknown app "%s"' % config['app'])
+        for name, value in settings.items():
+            self.cfg.set(name, value)
+        self.cfg.set('worker_exit', worker_exit)
+
+    def load(self):
+        # Called in the worker.
+        fs = create_filesystem(self.config)
+        if self.config['app'] == 'asgi':
+            from .asgi import AsyncKairCSApplication
+            app = AsyncKairCSApplication(fs, workers=self.config['threads'])
+        else:
+            from .http import KairCSApplication
+            app = KairCSApplication(fs)
+        return app
+
+
+def worker_exit(server, worker):
+    # Wait for the background deletions, and release the connections.
+    app = worker.wsgi
+    fs = getattr(app, 'fs', None)
+    if fs is not None:
+        fs.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='kaircs',
+                                     description='Run the KairCS service.')
+    parser.add_argument('-c', '--config', default=None,
+                        help='The configuration file.  Defaults to the '
+                        'environment variable KAIRCS_CONFIG.')
+    args = parser.parse_args(argv)
+    KairCSServer(args.config).run()
+
+
+if __name__ == '__main__':
+    main()
@@ -15,9 +15,17 @@ from __future__ import (division as _py3_division,
                         print_function as _py3_print,
                         absolute_import as _py3_abs_import)
 
+import io
+import os
 import math
+import binascii
+import itertools
 import hashlib
 import struct
+import threading
+import zlib
+from collections import deque, namedtuple
+from contextlib import contextmanager
 
 from xoutil.eight import binary_type, text_type
 
@@ -35,10 +43,75 @@ class BlobStore(object):
     :param bucket_type: The name of the bucket type to use for the
                         store. If None we don't use bucket types.
 
+    :param workers: The maximum number of threads used to talk to Riak KV
+                    concurrently (e.g. to read chunks ahead).  If None, the
+                    default of `concurrent.futures.ThreadPoolExecutor`:class:
+                    is used.
+
+    :param dedup: If True, new blobs are deduplicated: their chunks are
+                  stored under the SHA-256 of their contents, and the first
+                  chunk of the blob holds the list of the hashes (the
+                  manifest) instead of data.  Storing a chunk which is
+                  already in the store costs a look up instead of a write.
+                  Blobs are read in the same way whether they are
+                  deduplicated or not.
+
+    :param refcount_bucket_type: The name of the bucket type (of counters)
+                                 where the references to deduplicated
+                                 chunks are counted.  A chunk is deleted
+                                 when the last blob referencing it is
+                                 deleted.
+
+    :param compression: The name of the codec (see `CODECS`:data:) which
+                        compresses the chunks of new blobs, or None.  Each
+                        chunk is compressed on its own, so any chunk can
+                        be read without the others.  The codec is recorded
+                        in the header of the blob: blobs are read in the
+                        same way whether they are compressed or not.
+
+    :param small_blob_size: Blobs up to this size (and smaller than a
+                            chunk) are written with a single request.  See
+                            `BlobWriter`:class:.  If 0, every blob is looked
+                            up and marked as dirty before it's written.
+
+    :param delete_window: The maximum number of chunks of a blob being
+                          deleted at the same time.  See
+                          `Blob.delete`:meth:.
+
+    :param chunk_cache_dir: A local directory where chunks are cached (see
+                            `ChunkCache`:class:).  If None, chunks are
+                            always fetched from Riak KV.
+
+    :param chunk_cache_size: The maximum size (in bytes) of the chunks in
+                             the cache, for all the processes using
+                             `chunk_cache_dir`.
+
     '''
 
-    def __init__(self, backend, name, bucket_type='vsbs'):
+    def __init__(self, backend, name, bucket_type='vsbs', workers=None,
+                 dedup=False, refcount_bucket_type='counters',
+                 compression=None, small_blob_size=0, delete_window=8,
+                 chunk_cache_dir=None, chunk_cache_size=1024 ** 3):
         from riak import RiakClient
+        self.workers = workers
+        self.delete_window = delete_window
+        if chunk_cache_dir:
+            #: The `ChunkCache`:class: of the store, or None.
+            self.cache = ChunkCache(chunk_cache_dir, chunk_cache_size)
+        else:
+            self.cache = None
+        self.dedup = dedup
+        self.small_blob_size = small_blob_size
+        if compression:
+            try:
+                self.codec = CODECS[compression]
+            except KeyError:
+                raise ValueError('Unknown codec "%s"' % compression)
+        else:
+            self.codec = None
+        self._executor = None
+        self._executor_lock = threading.Lock()
+        self._write_once = None if bucket_type else False
         if isinstance(backend, RiakClient):
             self.riak = riak = backend
             self.owns_riak = False
@@ -50,15 +123,54 @@ class BlobStore(object):
             self.bucket = bucket_type.bucket(name)
         else:
             self.bucket = riak.bucket(name)
+        if dedup:
+            refcount_bucket_type = riak.bucket_type(refcount_bucket_type)
+            self.refcounts = refcount_bucket_type.bucket(name)
+        else:
+            self.refcounts = None
+
+    @property
+    def write_once(self):
+        '''True if the bucket of the store is of a ``write_once`` type.
+
+        Riak KV stores the objects of such buckets without reading them
+        first, so ``if_none_match`` is not enforced there: the writers look
+        blobs up instead (see `BlobWriter`:class:).  The properties of the
+        bucket are fetched the first time.
+
+        '''
+        if self._write_once is None:
+            props = self.bucket.get_properties()
+            self._write_once = bool(props.get('write_once'))
+        return self._write_once
+
+    @property
+    def executor(self):
+        '''The pool of threads shared by all the blobs of the store.
+
+        The pool is created the first time it's needed.
+
+        '''
+        if self._executor is None:
+            with self._executor_lock:
+                if self._executor is None:
+                    from concurrent.futures import ThreadPoolExecutor
+                    self._executor = ThreadPoolExecutor(
+                        max_workers=self.workers
+                    )
+        return self._executor
 
     def close(self):
+        executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False)
         if self.owns_riak:
             self.riak.close()
 
     def __del__(self):
         self.close()
 
-    def open(self, name, mode='r', fs_encoding=None):
+    def open(self, name, mode='r', fs_encoding=None, **options):
         '''Open a Blob within the store to either write or read.
 
         The returned object will have only a `read <BlobReader.read>`:meth: or
@@ -67,6 +179,24 @@ class BlobStore(object):
         :param name: The name of the blob.  It cannot be empty.
         :type name: bytes
 
+        :param options: Passed to `BlobReader`:class: or
+                        `BlobWriter`:class:.  For instance, ``readahead=4``
+                        makes the reader fetch up to 4 chunks in advance.
+
+        '''
+        blob = self.get_blob(name)
+        if mode == 'r':
+            return BlobReader(blob, **options)
+        elif mode == 'w':
+            return BlobWriter(blob, **options)
+        else:
+            raise ValueError('mode must be r or w')
+
+    def get_blob(self, name):
+        '''Return the `Blob`:class: with the given `name`.
+
+        The blob is not fetched.
+
         '''
         if isinstance(name, text_type):
             name = name.encode('utf-8')
@@ -74,13 +204,7 @@ class BlobStore(object):
             raise TypeError('Blob names must be bytes/str')
         if not name:
             raise ValueError('Blob name cannot be empty')
-        blob = Blob(name, self)
-        if mode == 'r':
-            return BlobReader(blob)
-        elif mode == 'w':
-            return BlobWriter(blob)
-        else:
-            raise ValueError('mode must be r or w')
+        return Blob(name, self)
 
     def put(self, filename, name=None):
         '''Put a file in the blob store.
@@ -101,27 +225,141 @@ class BlobStore(object):
         Return the contents of the file.
 
         '''
-        result = []
         with self.open(filename, 'r') as blob:
-            # I really expect to have less than 20 chunks if you're using this
-            # method... If your files are large and you still use this method,
-            # you're not your friend!
-            chunk = blob.read(20 * Blob.CHUNK_SIZE)
-            while chunk:
-                result.append(chunk)
-                chunk = blob.read(20 * Blob.CHUNK_SIZE)
-        return b''.join(result)
+            return blob.readall()
+
+    def read_range(self, name, start, end=None):
+        '''Read the bytes of a blob from `start` up to `end` (excluded).
+
+        If `end` is None or past the end of the blob, read until the end of
+        the blob.
+
+        Only the chunks covering the range are fetched (concurrently), plus
+        the first one which has the metadata of the blob.
+
+        '''
+        if start < 0 or (end is not None and end < 0):
+            raise ValueError('Negative offsets are not supported')
+        blob = self.get_blob(name)
+        first_chunk = BlobChunk(blob, 0)
+        first_data = first_chunk.content  # loads the metadata
+        size = blob.metadata.size
+        end = size if end is None else min(end, size)
+        if start >= end:
+            return b''
+        first, last = blob.chunk_index(start), blob.chunk_index(end - 1)
+        indexes = range(max(1, first), last + 1)
+        if len(indexes) > 1:
+            contents = self.executor.map(
+                lambda index: BlobChunk(blob, index).content,
+                indexes
+            )
+        else:
+            contents = (BlobChunk(blob, index).content for index in indexes)
+        if first == 0:
+            contents = itertools.chain([first_data], contents)
+        result = bytearray(end - start)
+        view = memoryview(result)
+        position, offset = 0, start - first * Blob.CHUNK_SIZE
+        for data in contents:
+            data = memoryview(data)[offset:offset + len(result) - position]
+            view[position:position + len(data)] = data
+            position += len(data)
+            offset = 0
+        assert position == len(result)
+        return binary_type(result)
 
     def write(self, filename, contents):
         assert isinstance(contents, binary_type)
         with self.open(filename, 'w') as write:
             write(contents)
 
-    def delete(self, name):
-        '''Delete a blob.'''
+    def delete(self, name, window=None):
+        '''Delete a blob.  See `Blob.delete`:meth:.'''
         if isinstance(name, text_type):
             name = name.encode('utf-8')
-        Blob(name, self).delete()
+        Blob(name, self).delete(window=window)
+
+    def put_content(self, data, codec=None):
+        '''Store `data` as a deduplicated chunk, and take a reference to it.
+
+        If `codec` is given, `data` is compressed first; the chunk is
+        identified by what is stored.  If a chunk with the same contents is
+        already stored, it's not written again.  Return the SHA-256 of the
+        stored data (the digest, not its hex representation).
+
+        '''
+        from riak import RiakObject
+        from riak.datatypes import Counter
+        if codec is not None:
+            data = codec.compress(data)
+        digest = hashlib.sha256(data).digest()
+        refcount = Counter(bucket=self.refcounts, key=_hex(digest))
+        refcount.increment()
+        refcount.store(return_body=True)
+        robj = RiakObject(self.riak, self.bucket, content_key(digest))
+        if refcount.value > 1:
+            # Another blob holds a reference.  If it's being released (see
+            # `release_content`:meth:), the chunk is restored.
+            robj.reload(r=1, head_only=True)
+            exists = robj.exists
+        else:
+            # Ours is the only reference: the chunk may be new, or being
+            # deleted by the release of the last reference.  Storing it after
+            # taking the reference keeps it.
+            exists = False
+        if not exists:
+            self._store_content(robj, data)
+        return digest
+
+    def release_content(self, digest, throttle=None):
+        '''Drop a reference to the deduplicated chunk with the `digest`.
+
+        The chunk is deleted when there are no references left.  A blob may
+        take a reference while the chunk is being deleted: the counter is
+        read again after the deletion, and the chunk is restored if it's
+        referenced.
+
+        If `throttle` is given, it's called before each request to Riak KV
+        (e.g. to limit their rate).
+
+        '''
+        from riak import RiakObject
+        from riak.datatypes import Counter
+        if throttle is None:
+            throttle = _noop
+        refcount = Counter(bucket=self.refcounts, key=_hex(digest))
+        refcount.decrement()
+        throttle()
+        refcount.store(return_body=True)
+        if refcount.value <= 0:
+            key = content_key(digest)
+            robj = RiakObject(self.riak, self.bucket, key)
+            throttle()
+            robj.reload(r=1)
+            if robj.exists:
+                data = robj.encoded_data
+                throttle()
+                RiakObject(self.riak, self.bucket, key).delete()
+                # A writer that took a reference before this point may have
+                # found the chunk and not stored it; the writers after this
+                # point store it (they hold the only reference).
+                throttle()
+                refcount.reload()
+                if refcount.value > 0:
+                    throttle()
+                    self._store_content(RiakObject(self.riak, self.bucket,
+                                                   key), data)
+                    return
+            if self.cache is not None:
+                self.cache.discard(key)
+
+    def _store_content(self, robj, data):
+        robj.content_type = 'application/octet-stream'
+        if self.riak.protocol != 'http':
+            data = _tobytes(data)
+        robj.encoded_data = data
+        robj.store(w=1, return_body=False)
 
 
 class Blob(object):
@@ -146,17 +384,88 @@ class Blob(object):
             BlobChunk(self, 0).content
         return self.metadata.size
 
+    def chunk_index(self, position):
+        '''Return the index of the chunk holding the byte at `position`.'''
+        return position // self.CHUNK_SIZE
+
     @property
     def master_key(self):
         return hashlib.sha256(self.name).hexdigest()
 
-    def delete(self):
+    def cache_key(self, key):
+        '''Return the key of the chunk `key` in the `ChunkCache`:class:.
+
+        Deduplicated chunks are identified by their contents.  The other
+        chunks are identified by their key and the `stamp
+        <BlobMetadata.stamp>`:attr: of the blob, so that a blob deleted and
+        written again (maybe by another process) doesn't get the old chunks.
+        Return None if the chunk can't be cached.
+
+        '''
+        if key.startswith(CONTENT_PREFIX):
+            return key
+        stamp = self.metadata.stamp
+        return None if stamp is None else '{}@{}'.format(key, stamp)
+
+    def delete(self, window=None):
+        '''Delete the blob.
+
+        The first chunk is deleted first, so that the blob is gone for the
+        readers at once.  Then the other chunks are deleted (or, if the blob
+        is deduplicated, the references to its chunks are released), up to
+        `window` at the same time in the `executor
+        <BlobStore.executor>`:attr: of the store.  If `window` is None, use
+        the `delete_window` of the store; if 0, delete the chunks one at a
+        time.
+
+        If the deletion of any chunk fails, the others are deleted anyway
+        and the first error is raised.  The chunks left behind are collected
+        by `kaircs.service.gc`:mod:.
+
+        '''
         # DELETION IS TOUGH: Since writing a large file requires several
         # writes (chunks), a file may be partially written but yet
         # inaccessible (the first chunk is the last to be written).  We assume
         # that you delete a file after it's completely written.
-        for i in range(self.length):
-            BlobChunk(self, i).delete()
+        first_chunk = BlobChunk(self, 0)
+        try:
+            first_chunk.load_metadata()
+        except KeyError:
+            return
+        first_chunk.delete()
+        manifest = self.metadata.manifest
+        if manifest is not None:
+            release = self.store.release_content
+            tasks = ((release, digest) for digest in manifest)
+        else:
+            tasks = (
+                (BlobChunk.delete, BlobChunk(self, i))
+                for i in range(1, self.length)
+            )
+        if window is None:
+            window = self.store.delete_window
+        if not window:
+            for fn, arg in tasks:
+                fn(arg)
+            return
+        executor = self.store.executor
+        in_flight = deque()
+        errors = []
+
+        def wait():
+            try:
+                in_flight.popleft().result()
+            except Exception as error:
+                errors.append(error)
+
+        for fn, arg in tasks:
+            while len(in_flight) >= window:
+                wait()
+            in_flight.append(executor.submit(fn, arg))
+        while in_flight:
+            wait()
+        if errors:
+            raise errors[0]
 
 
 class ClosingContextManager(object):
@@ -167,18 +476,80 @@ class ClosingContextManager(object):
         return self.close()
 
 
-class BlobReader(ClosingContextManager):
-    def __init__(self, blob):
+class BlobReader(io.RawIOBase):
+    '''Read a blob.
+
+    The blob is read from begin to end, but you may `seek`:meth: to any
+    position.
+
+    This is a raw (unbuffered) binary stream.  You may wrap it in an
+    `io.BufferedReader`:class:, or use `readinto`:meth: to read directly
+    into your own buffers.
+
+    :param readahead: The maximum number of chunks to fetch in advance while
+                      the current one is being consumed.  Chunks are fetched
+                      (and decompressed) concurrently in the `executor
+                      <BlobStore.executor>`:attr: of the store.  At most
+                      `readahead` chunks (besides the current one) are kept in
+                      memory.  If 0, chunks are read only when needed.
+
+    '''
+    def __init__(self, blob, readahead=0):
+        super(BlobReader, self).__init__()
         self.blob = blob
+        self.readahead = max(0, readahead or 0)
+        self.prefetched = deque()  # (index, future) of the chunks ahead
+        self.next_prefetch = 1     # the index of the next chunk to prefetch
+        self.decode = True         # whether chunks are decompressed
         # Force the first chunk to be read so that metadata is loaded, this
         # also ensures we can't open a non-existing blob.
         chunk = BlobChunk(blob, 0)
         self.current = 0
-        self.chunk_data = chunk.content
+        self.chunk_data = memoryview(chunk.content)
+        self.first_encoded = chunk.encoded_data
         self.chunk_position = 0
         self.consumed = 0
         self.length = blob.length
 
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        '''Change the position of the reader in the blob.
+
+        Only the chunk holding the new position is fetched.  Seeking past
+        the end of the blob is allowed, but there will be nothing to read.
+
+        Return the new position.
+
+        '''
+        if whence == io.SEEK_SET:
+            position = offset
+        elif whence == io.SEEK_CUR:
+            position = self.consumed + offset
+        elif whence == io.SEEK_END:
+            position = self.blob.metadata.size + offset
+        else:
+            raise ValueError('Invalid whence (%r)' % whence)
+        if position < 0:
+            raise ValueError('Negative seek position %r' % position)
+        index = self.blob.chunk_index(position)
+        if index != self.current:
+            self.current = index
+            if index < self.length:
+                self.chunk_data = memoryview(self.fetch(index))
+            else:
+                self.chunk_data = memoryview(b'')
+        self.chunk_position = position - index * Blob.CHUNK_SIZE
+        self.consumed = position
+        return position
+
+    def tell(self):
+        return self.consumed
+
     def read(self, size=None):
         '''Read up-to `size` bytes from the Blob.
 
@@ -189,51 +560,61 @@ class BlobReader(ClosingContextManager):
         consumed will return ``b''``.
 
         '''
-        if self.consumed >= self.blob.metadata.size:
-            return b''
-        consumed = 0
         size = Blob.CHUNK_SIZE if size is None or size <= 0 else size
-        result = []
-
-        def get():
-            if consumed < size:
-                request = size - consumed
-                data = self.read_current(request)
-                if request and len(data) < request:
-                    # we requested more than what we got, this means the
-                    # current chunk is depleted, so move on to the next one.
-                    self.advance()
-                return data
-            else:
-                return b''
+        size = min(size, self.blob.metadata.size - self.consumed)
+        if size <= 0:
+            return b''
+        self.prefetch()
+        data = self.read_current(size)
+        if len(data) == size:
+            # The most common case: the data is in the current chunk.
+            self.consumed += size
+            return data.tobytes()
+        else:
+            buffer = bytearray(size)
+            view = memoryview(buffer)
+            read = len(data)
+            view[:read] = data
+            self.consumed += read
+            read += self.readinto(view[read:])
+            return view[:read].tobytes()
+
+    def readall(self):
+        '''Read until the end of the blob.'''
+        return self.read(self.blob.metadata.size - self.consumed)
 
-        data = get()
-        while data:
-            result.append(data)
-            consumed += len(data)
-            data = get()
+    def readinto(self, buffer):
+        '''Read up-to ``len(buffer)`` bytes into `buffer`.
 
-        # The previous loop may end up at the very end of the current chunk,
-        # no more data to read from it, but more chunks after it; however
-        # since `get()` only advances when during true consumption, this would
-        # make the next call to read to return b'', so we need to force an
-        # advance in such a case.
-        if self.chunk_position >= len(self.chunk_data):
-            self.advance()
+        Return the number of bytes read.  Return 0 only at the end of the
+        blob (or if `buffer` is empty).
 
-        self.consumed += consumed
-        return b''.join(result)
+        '''
+        view = memoryview(buffer)
+        if view.itemsize != 1:
+            view = view.cast('B')
+        read = 0
+        size = min(len(view), self.blob.metadata.size - self.consumed)
+        self.prefetch()
+        while read < size:
+            data = self.read_current(size - read)
+            if data:
+                view[read:read + len(data)] = data
+                read += len(data)
+            elif not self.advance():
+                break
+        self.consumed += read
+        return read
 
     def read_current(self, size=None):
         '''Read from the current chunk in the reader.
 
-        If the current chunk is exhausted, return ``b''``.  This won't advance
+        Return a `memoryview`:class: of the chunk (no data is copied).  If the
+        current chunk is exhausted, the result is empty.  This won't advance
         the current chunk.
 
         '''
         size = Blob.CHUNK_SIZE if size is None else size
-        if not size:
-            return b''
         pos = self.chunk_position
         res = self.chunk_data[pos:pos + size]
         self.chunk_position += len(res)
@@ -248,35 +629,191 @@ class BlobReader(ClosingContextManager):
         '''
         self.current += 1
         if self.current < self.length:
-            self.chunk_data = BlobChunk(self.blob, self.current).content
+            self.chunk_data = memoryview(self.fetch(self.current))
             self.chunk_position = 0
             return True
         else:
             return False
 
-    def close(self, **options):
-        self.chunk = None
+    def fetch(self, index):
+        '''Return the data of the chunk at `index`.
 
+        If the chunk was prefetched, wait for it; and keep the read-ahead
+        window full.
 
-class BlobWriter(ClosingContextManager):
-    def __init__(self, blob, options=None):
-        try:
-            BlobChunk(blob, 0).get()
-        except KeyError:
-            pass
+        '''
+        prefetched = self.prefetched
+        # Discard the chunks we are not going to read (after a seek).
+        while prefetched and prefetched[0][0] != index:
+            _, future = prefetched.popleft()
+            future.cancel()
+        if prefetched:
+            _, future = prefetched.popleft()
+            data = future.result()
         else:
-            raise ValueError('Cannot overwrite a blob')
-        # Store the first chunk in Riak KV so that:
-        #
-        # - We know that there's a partial (dirty=True) blob there.
-        # - We can recover from such issues.
-        BlobChunk(blob, 0).store()
+            data = BlobChunk(self.blob, index).get(self.decode)
+            self.next_prefetch = index + 1
+        self.prefetch()
+        return data
+
+    def prefetch(self):
+        '''Schedule the fetch of the chunks ahead of the current one.
+
+        Never schedules more than `readahead` chunks.
+
+        '''
+        if self.readahead:
+            executor = self.blob.store.executor
+            while (len(self.prefetched) < self.readahead and
+                   self.next_prefetch < self.length):
+                index = self.next_prefetch
+                future = executor.submit(BlobChunk(self.blob, index).get,
+                                         self.decode)
+                self.prefetched.append((index, future))
+                self.next_prefetch += 1
+
+    def iter_encoded(self):
+        '''Yield the data of the chunks as stored, i.e. compressed.
+
+        The chunks are compressed with the `codec <BlobMetadata.codec>`:attr:
+        of the blob, each one on its own.  They are read ahead as with
+        `read`:meth:.  Use this instead of reading the blob, not mixed with
+        it.
+
+        '''
+        self.decode = False
+        while self.prefetched:
+            _, future = self.prefetched.pop()
+            future.cancel()
+        self.next_prefetch = 1
+        self.prefetch()
+        yield _tobytes(self.first_encoded)
+        for index in range(1, self.length):
+            yield self.fetch(index)
+
+    def close(self):
+        while self.prefetched:
+            _, future = self.prefetched.pop()
+            future.cancel()
+        self.chunk_data = memoryview(b'')
+        self.first_encoded = None
+        super(BlobReader, self).close()
+
+
+class BlobWriter(ClosingContextManager):
+    '''Write a blob.
+
+    :param options: Low level options passed to the ``store`` method of the
+                    riak object of every chunk.
+
+    :param if_none_match: If True, don't look up the blob before writing
+                          it; instead ask Riak KV to fail if any of the
+                          chunks already exists.  Raise ValueError if the
+                          blob already exists.  Ignored if the bucket is
+                          `write once <BlobStore.write_once>`:attr:.
+
+    :param window: The maximum number of chunks being stored at the same
+                   time.  Full chunks are stored concurrently in the
+                   `executor <BlobStore.executor>`:attr: of the store, while
+                   the caller keeps writing; when there are `window` chunks in
+                   flight, `write`:meth: waits for the oldest to be stored.
+                   If 0, every chunk is stored as soon as it gets full.
+
+    :param on_close: A callable called with the writer after the blob is
+                     completely stored (i.e. at the end of `close`:meth:).
+
+    :param small_blob_size: Blobs up to this size (and smaller than a chunk)
+                            are written with a single request when the
+                            writer is closed: the first chunk with the
+                            clean header, and ``if_none_match`` (or a look
+                            up, in `write once
+                            <BlobStore.write_once>`:attr: buckets).  Nothing
+                            is stored (nor looked up) until the blob grows
+                            beyond this size; thus trying to overwrite a
+                            small blob fails when closing.  Small blobs are
+                            not deduplicated.  If None, use the
+                            `small_blob_size` of the store.
+
+    If the store deduplicates (see `BlobStore`:class:), every chunk
+    (including the first one) is stored with
+    `~BlobStore.put_content`:meth:, and the first chunk of the blob is
+    written with the manifest.
+
+    If the store compresses, chunks are compressed where they are stored:
+    with a `window`, in the executor of the store.
+
+    If writing fails (e.g. a chunk could not be stored, maybe in the
+    background), the first error is kept in `error`; and `close`:meth:
+    raises it instead of storing the first chunk, so the blob stays dirty.
+
+    '''
+    def __init__(self, blob, options=None, if_none_match=False, window=0,
+                 on_close=None, small_blob_size=None):
+        first_chunk = BlobChunk(blob, 0)
+        blob.metadata.codec = blob.store.codec
+        self.dedup = blob.store.dedup
         self.blob = blob
         self.metadata = blob.metadata
         self.written = 0
-        self.chunk = self.first_chunk = BlobChunk(blob, 0)
+        self.chunk = self.first_chunk = first_chunk
         self.chunk_size = 0
+        if if_none_match and blob.store.write_once:
+            if_none_match = False
+        self.if_none_match = if_none_match
+        if small_blob_size is None:
+            small_blob_size = blob.store.small_blob_size
+        self.small_blob_size = small_blob_size
+        self.started = False
+        if not small_blob_size:
+            self.start()
+        self.allocate(first_chunk)
+        self.first_buffer = self.buffer
         self.options = dict(options or {})
+        if if_none_match:
+            self.options['if_none_match'] = True
+        self.window = max(0, window or 0)
+        self.in_flight = deque()
+        self.on_close = on_close
+        self.error = None
+
+    def start(self):
+        '''Store the first chunk of the blob, marked as dirty.
+
+        Unless `if_none_match`, look up the blob first and raise ValueError
+        if it exists.
+
+        '''
+        from riak import RiakError
+        blob, first_chunk = self.blob, self.first_chunk
+        if not self.if_none_match:
+            try:
+                BlobChunk(blob, 0).get()
+            except KeyError:
+                pass
+            else:
+                raise ValueError('Cannot overwrite a blob')
+        # Store the first chunk in Riak KV so that:
+        #
+        # - We know that there's a partial (dirty=True) blob there.
+        # - We can recover from such issues.
+        #
+        # The first chunk is written again when the writer is closed, so we
+        # ask for the body (just the header at this point) to keep the
+        # vclock, and avoid siblings.
+        if self.dedup:
+            blob.metadata.flags |= BlobMetadata.DEDUPLICATED
+            blob.metadata.manifest = []
+        try:
+            first_chunk.store(store_options=dict(
+                return_body=True,
+                if_none_match=self.if_none_match
+            ))
+        except RiakError:
+            if self.if_none_match:
+                raise ValueError('Cannot overwrite a blob')
+            else:
+                raise
+        self.started = True
 
     def write(self, data, **options):
         '''Write `data` to the blob.
@@ -288,33 +825,129 @@ class BlobWriter(ClosingContextManager):
                            are allowed.  We set ``w=1`` by default.
 
         '''
+        if self.error is not None:
+            raise self.error
+        try:
+            self._write(data, options)
+        except Exception as error:
+            self.error = error
+            raise
+
+    __call__ = write
+
+    def _write(self, data, options):
         # write to the current chunk until it fills, when the chunk is full
         # write it to the Riak KV backend, and create another chunk to be
         # filled.  Stop when all data is writen.
-        chunk = self.chunk
+        #
+        # The data is copied once: from `data` to the buffer of the chunk,
+        # and the buffer is what we give to the transport.
+        data = memoryview(data)
         wr, size = 0, len(data)
+        if not self.started and self.written + size > self.small_blob_size:
+            self.start()
+        chunk = self.chunk
         while wr < size:
             needed = Blob.CHUNK_SIZE - self.chunk_size
             chunk_data = data[wr: wr + needed]
             wr += len(chunk_data)
-            chunk.data += chunk_data
+            start = self.offset + self.chunk_size
+            self.buffer[start:start + len(chunk_data)] = chunk_data
             self.chunk_size += len(chunk_data)
             assert self.chunk_size <= Blob.CHUNK_SIZE
             if self.chunk_size == Blob.CHUNK_SIZE:
-                if chunk.index:
+                if not self.started:
+                    self.start()
+                if self.dedup:
+                    self.store_content(self.buffer)
+                elif chunk.index:
                     # Notice that the first chunk (with index 0) won't be
                     # written until the whole blob is written.  This is
                     # because we need to append the blob's metadata which
                     # includes the size of the blob, and we don't know that
                     # until the end of the write.
-                    chunk.store(store_options=dict(self.options, **options))
+                    chunk.data = self.buffer
+                    self.store_chunk(chunk, dict(self.options, **options))
                 self.chunk = chunk = BlobChunk(self.blob, chunk.index + 1)
                 self.chunk_size = 0
+                self.allocate(chunk)
         self.written += size
 
-    __call__ = write
+    def allocate(self, chunk):
+        '''Allocate the buffer where the data of `chunk` is assembled.
+
+        The buffer of the first chunk leaves room for the header of the blob,
+        so that it can be stored without copying its data.
+
+        '''
+        if chunk.index or self.dedup:
+            self.offset = 0
+        else:
+            self.offset = BlobMetadata.HEADER_SIZE
+        self.buffer = memoryview(bytearray(self.offset + Blob.CHUNK_SIZE))
+
+    def store_chunk(self, chunk, store_options):
+        '''Store a chunk other than the first one.
+
+        If the writer has a `window`, the chunk is stored in background;
+        but first wait until there's room in the window.
+
+        '''
+        assert chunk.index
+        if self.window:
+            in_flight = self.in_flight
+            while len(in_flight) >= self.window:
+                in_flight.popleft().result()
+            executor = self.blob.store.executor
+            in_flight.append(executor.submit(chunk.store, store_options))
+        else:
+            chunk.store(store_options=store_options)
+
+    def store_content(self, data):
+        '''Store a chunk of a deduplicated blob.
+
+        Like `store_chunk`:meth:, but the digest of the chunk (or the future
+        of it) is added to the manifest.
+
+        '''
+        store = self.blob.store
+        if self.window:
+            in_flight = self.in_flight
+            while len(in_flight) >= self.window:
+                in_flight.popleft().result()
+            future = store.executor.submit(store.put_content, data,
+                                           self.metadata.codec)
+            in_flight.append(future)
+            self.metadata.manifest.append(future)
+        else:
+            digest = store.put_content(data, self.metadata.codec)
+            self.metadata.manifest.append(digest)
+
+    def flush(self):
+        '''Wait until all the chunks in flight are stored.
+
+        If any of them failed, raise the first error.
+
+        '''
+        error = None
+        in_flight = self.in_flight
+        while in_flight:
+            try:
+                in_flight.popleft().result()
+            except Exception as e:
+                error = error or e
+        if error is not None:
+            self.error = self.error or error
+            raise error
 
     def close(self, **options):
+        if self.error is not None:
+            # Don't mark as complete a blob that misses some chunk.
+            try:
+                self.flush()
+            except Exception:
+                pass
+            raise self.error
         # At this point we know the size the of the blob so we can complete
         # the data of the first chunk and write it.
         first_chunk = self.first_chunk
@@ -322,46 +955,170 @@ class BlobWriter(ClosingContextManager):
         meta.dirty = False
         meta.size = self.written
         assert self.chunk_size < Blob.CHUNK_SIZE
-        if 0 < self.chunk_size < Blob.CHUNK_SIZE:
+        store_options = dict(self.options, **options)
+        if not self.started:
+            self.close_small(store_options)
+            return
+        if self.dedup:
+            if self.chunk_size:
+                self.store_content(self.buffer[:self.chunk_size])
+        elif self.chunk is not first_chunk and self.chunk_size:
             # The last chunk is still partially filled, we have to write it
             # now.
-            self.chunk.store(store_options=dict(self.options, **options))
-        if first_chunk is not self.chunk:
-            first_chunk.store(store_options=dict(self.options, **options))
-        elif self.chunk_size == 0:
-            assert self.written == 0  # Empty file
-            first_chunk.store(store_options=dict(self.options, **options))
+            self.chunk.data = self.buffer[:self.chunk_size]
+            self.store_chunk(self.chunk, dict(store_options))
+        # The first chunk must be the last one written, so that readers
+        # never see a clean blob with missing chunks.
+        self.flush()
+        # The first chunk does exist (it's dirty), so 'if_none_match' is not
+        # for it.
+        store_options.pop('if_none_match', None)
+        if self.dedup:
+            meta.manifest = [
+                digest if isinstance(digest, binary_type) else digest.result()
+                for digest in meta.manifest
+            ]
+            first_chunk.raw_data = meta.header + b''.join(meta.manifest)
+        else:
+            if self.chunk is first_chunk:
+                size = self.chunk_size
+            else:
+                size = Blob.CHUNK_SIZE
+            header_size = BlobMetadata.HEADER_SIZE
+            if meta.codec is not None:
+                data = self.first_buffer[header_size:header_size + size]
+                first_chunk.raw_data = meta.header + meta.encode(data)
+            else:
+                self.first_buffer[:header_size] = meta.header
+                first_chunk.raw_data = self.first_buffer[:header_size + size]
+        first_chunk.store(store_options=store_options)
+        self.closed()
+
+    def close_small(self, store_options):
+        '''Store a small blob with a single request.'''
+        from riak import RiakError
+        first_chunk, meta = self.first_chunk, self.metadata
+        data = self.buffer[self.offset:self.offset + self.chunk_size]
+        first_chunk.raw_data = meta.header + meta.encode(data)
+        if self.blob.store.write_once:
+            robj = first_chunk.new_riak_obj()
+            robj.reload(r=1, head_only=True)
+            if robj.exists:
+                raise ValueError('Cannot overwrite a blob')
+        else:
+            store_options['if_none_match'] = True
+        try:
+            first_chunk.store(store_options=store_options)
+        except RiakError:
+            if store_options.get('if_none_match'):
+                raise ValueError('Cannot overwrite a blob')
+            else:
+                raise
+        self.closed()
+
+    def closed(self):
         self.chunk = None  # avoid more writing
+        self.buffer = self.first_buffer = None
+        if self.on_close is not None:
+            self.on_close(self)
 
 
 class BlobMetadata(object):
     HEADER_FMT = '<BQ?'
     HEADER_SIZE = struct.calcsize(HEADER_FMT)
 
+    #: The extension of the header: the version of the format, flags and
+    #: the id of the codec of the chunks.  Blobs without flags nor codec are
+    #: written without it.
+    EXTENSION_FMT = '<BBB'
+    EXTENSION_SIZE = struct.calcsize(EXTENSION_FMT)
+    VERSION = 1
+
+    #: The flag of deduplicated blobs.  The data of their first chunk is
+    #: the manifest: the SHA-256 of each chunk, see `BlobStore`:class:.
+    DEDUPLICATED = 0x01
+
     def __init__(self):
         self.metadata_size = None
         self.size = 0
         self.dirty = True
+        self.version = 0
+        self.flags = 0
+        self.manifest = None
+        #: The `Codec`:class: of the chunks, or None if they are not
+        #: compressed.
+        self.codec = None
+        #: The version of the first chunk as fetched (its ETag, or when it
+        #: was last modified), or None.
+        self.stamp = None
 
     @property
     def header(self):
-        return struct.pack(self.HEADER_FMT, self.HEADER_SIZE, self.size,
-                           self.dirty)
+        codec = self.codec
+        if self.flags or codec is not None:
+            size = self.HEADER_SIZE + self.EXTENSION_SIZE
+            return (
+                struct.pack(self.HEADER_FMT, size, self.size, self.dirty) +
+                struct.pack(self.EXTENSION_FMT, self.VERSION, self.flags,
+                            codec.id if codec is not None else 0)
+            )
+        else:
+            return struct.pack(self.HEADER_FMT, self.HEADER_SIZE, self.size,
+                               self.dirty)
+
+    def encode(self, data):
+        '''Return the data of a chunk as it's stored.'''
+        if self.codec is None or not len(data):
+            return data
+        else:
+            return self.codec.compress(data)
+
+    def decode(self, data):
+        '''Return the data of a chunk from what's stored.'''
+        if self.codec is None or not len(data):
+            return data
+        else:
+            return self.codec.decompress(data)
 
     def extract(self, rawdata):
         assert len(rawdata) >= self.HEADER_SIZE
-        header, data = rawdata[:self.HEADER_SIZE], rawdata[self.HEADER_SIZE:]
+        # Slicing the memoryview avoids copying the data.
+        rawdata = memoryview(rawdata)
+        header = rawdata[:self.HEADER_SIZE].tobytes()
+        data = rawdata[self.HEADER_SIZE:]
         msize, size, dirty = struct.unpack(self.HEADER_FMT, header)
         self.metadata_size = msize
         self.size = size
         self.dirty = dirty
         if msize > self.HEADER_SIZE:
-            metadata, data = rawdata[:msize], rawdata[msize:]
+            metadata, data = rawdata[:msize].tobytes(), rawdata[msize:]
         else:
             assert msize == self.HEADER_SIZE
             metadata = header
-        # We can't assert for equality: this is just one chunk of the blob.
-        assert size >= len(data)
+        if msize >= self.HEADER_SIZE + self.EXTENSION_SIZE:
+            version, flags, codec = struct.unpack(
+                self.EXTENSION_FMT,
+                metadata[self.HEADER_SIZE:self.HEADER_SIZE +
+                         self.EXTENSION_SIZE]
+            )
+            if version > self.VERSION:
+                raise ValueError('Unsupported blob version %d' % version)
+            self.version, self.flags = version, flags
+            if codec:
+                try:
+                    self.codec = CODEC_IDS[codec]
+                except KeyError:
+                    raise ValueError('Unsupported codec %d' % codec)
+        if self.flags & self.DEDUPLICATED:
+            digest_size = hashlib.sha256().digest_size
+            self.manifest = [
+                data[i:i + digest_size].tobytes()
+                for i in range(0, len(data), digest_size)
+            ]
+        elif self.codec is None:
+            # We can't assert for equality: this is just one chunk of the
+            # blob.  (Compressed data of a small blob may be larger.)
+            assert size >= len(data)
         return metadata, data
 
 
@@ -372,52 +1129,137 @@ class BlobChunk(object):
         self.riak = blob.store.riak
         self.bucket = blob.store.bucket
         self.data = b''
+        # The data as stored in Riak KV, i.e with the header of the blob for
+        # the first chunk.  If None, it's made from `data` when storing.
+        self.raw_data = None
+        # The data as fetched, i.e. compressed; without the header.
+        self.encoded_data = None
         self.metadata = self.blob.metadata
         self.master_key = self.blob.master_key
+        self._robj = None
 
     def put(self, data, **kwargs):
         self.data = data
         self.store(store_options=kwargs)
 
     def store(self, store_options=None):
-        robj = self.riak_obj
+        robj = self._robj
+        if robj is None:
+            # We don't fetch the chunk before writing it: chunks are expected
+            # to be written once, so there's nothing to merge with.  This is
+            # called a blind write.
+            robj = self._robj = self.new_riak_obj()
         robj.content_type = 'application/octet-stream'
-        if self.index:
+        if self.raw_data is not None:
+            data = self.raw_data
+        elif self.index:
             assert self.data
-            robj.encoded_data = self.data
+            data = self.metadata.encode(self.data)
         else:
-            robj.encoded_data = self.metadata.header + self.data
+            data = self.metadata.header + self.metadata.encode(self.data)
+        if self.riak.protocol != 'http':
+            # The HTTP transport sends any buffer (bytearray, memoryview) as
+            # is, Protocol Buffers only take bytes.
+            data = _tobytes(data)
+        robj.encoded_data = data
         # If the 'vsbs' butcket type is a write-once w=1 should be redundant,
         # but let's be explicit in this case: We expect that that a chunk does
         # not get written often, in fact, we HIGHLY expect a single write
         # under normal (non failure) operations.  Setting w=1 allows to have
         # lower latency even if write-once is not set.  At the same time, we
         # will allow other values for 'w' if needed by the client.
+        #
+        # We don't need Riak to send us back the chunk we've just written.
         if not store_options:
             store_options = {}
         store_options.setdefault('w', 1)
+        store_options.setdefault('return_body', False)
         robj.store(**store_options)
 
-    def get(self):
-        robj = self.riak_obj
-        if not robj.exists:
-            raise KeyError(self.chunk_key)
+    def get(self, decode=True):
+        '''Fetch the data of the chunk.
+
+        If `decode` is False, return the data as stored (compressed with the
+        codec of the blob).
+
+        '''
         if self.index:
             # Any chunk but the first one will have only data
-            data = robj.encoded_data
+            data = self.fetch_cached(self.chunk_key)
         else:
-            _, data = self.metadata.extract(robj.encoded_data)
+            data = self.load_metadata()
             if self.metadata.dirty:
                 raise DirtyBlobError
+            manifest = self.metadata.manifest
+            if manifest is not None:
+                # The data of the first chunk is deduplicated as well.
+                if manifest:
+                    data = self.fetch_cached(content_key(manifest[0]))
+                else:
+                    data = b''
+        self.encoded_data = data
+        return self.metadata.decode(data) if decode else data
+
+    def load_metadata(self):
+        '''Fetch the first chunk, and load the metadata of the blob.
+
+        Return the data after the header: the manifest of deduplicated blobs.
+        Dirty blobs are not an error.
+
+        '''
+        assert self.index == 0
+        # The first chunk is never cached: it tells whether the blob exists.
+        robj = self.bucket.get(self.chunk_key, r=1)
+        if not robj.exists:
+            raise KeyError(self.chunk_key)
+        self.metadata.stamp = robj.etag or robj.last_modified
+        _, data = self.metadata.extract(robj.encoded_data)
+        return data
+
+    def fetch(self, key):
+        '''Return the contents of the object with the given `key`.'''
+        robj = self.bucket.get(key, r=1)
+        if not robj.exists:
+            raise KeyError(key)
+        return robj.encoded_data
+
+    def fetch_cached(self, key):
+        '''Like `fetch`:meth:, but look in the cache of the store first.
+
+        A chunk fetched from Riak KV is kept in the cache.
+
+        '''
+        cache = self.blob.store.cache
+        cache_key = self.blob.cache_key(key) if cache is not None else None
+        if cache_key is None:
+            return self.fetch(key)
+        data = cache.get(cache_key)
+        if data is None:
+            data = self.fetch(key)
+            cache.put(cache_key, data)
         return data
 
     def delete(self):
-        self.riak_obj.delete()
+        # Deleting a chunk doesn't require its contents.
+        self.new_riak_obj().delete()
+        cache = self.blob.store.cache
+        if cache is not None and self.index:
+            cache_key = self.blob.cache_key(self.chunk_key)
+            if cache_key is not None:
+                cache.discard(cache_key)
 
     @property
     def riak_obj(self):
         return self.bucket.get(self.chunk_key, r=1)
 
+    def new_riak_obj(self):
+        '''Return a new (not fetched) riak object for this chunk.'''
+        # We don't use `bucket.new()` because it looks up the properties of
+        # the bucket type (i.e. a request to Riak) to find out if it holds
+        # data types.  Chunks are never data types.
+        from riak import RiakObject
+        return RiakObject(self.riak, self.bucket, self.chunk_key)
+
     @property
     def content(self):
         if not self.data:
@@ -426,4 +1268,287 @@ class BlobChunk(object):
 
     @property
     def chunk_key(self):
-        return '{}/{}'.format(self.master_key, self.index)
+        manifest = self.metadata.manifest
+        if self.index and manifest is not None:
+            return content_key(manifest[self.index])
+        else:
+            return '{}/{}'.format(self.master_key, self.index)
+
+
+class ChunkCache(object):
+    '''A cache of chunks in the local `directory`.
+
+    Keeps up to `size` bytes of chunks, evicting the least recently used.
+    Chunks are kept as stored (i.e. compressed), one file each.  A chunk is
+    written to a temporary file, flushed to the disk, and then renamed; so a
+    crash never leaves a partial chunk in the cache.  The chunks found in
+    `directory` are reused.
+
+    The chunks of blobs never change; but a blob may be deleted and written
+    again.  See `Blob.cache_key`:meth: for how old chunks are never read.
+
+    The directory may be shared by several processes (e.g. the workers of
+    the server), and `size` is the budget of all of them.  The bytes taken
+    by the chunks are kept in the file ``usage`` of the directory, which
+    every process updates while it holds a lock on the file ``lock``.  When
+    they exceed `size`, the directory is scanned, and the chunks used least
+    recently (the modification time of a chunk is updated when it's read)
+    are removed until they take `LOW_WATER` times `size`.
+
+    '''
+    #: The suffix of the files being written.
+    TEMP_SUFFIX = '.tmp'
+
+    #: The fraction of `size` left after an eviction, so that the directory
+    #: is not scanned again for each chunk written to a full cache.
+    LOW_WATER = 0.9
+
+    def __init__(self, directory, size):
+        self.directory = directory
+        self.size = size
+        _makedirs(directory)
+        self.load()
+
+    @property
+    def used(self):
+        '''The bytes taken by the chunks in the directory.'''
+        with self._locked():
+            used = self._read_usage()
+            if used is None:
+                used = self._collect()
+        return used
+
+    def load(self):
+        '''Take the bytes used by the chunks already in the directory.
+
+        Temporary files left by a crash are removed.
+
+        '''
+        with self._locked():
+            self._collect(remove_temps=True)
+
+    def scan(self, remove_temps=False):
+        '''Return a list of tuples ``(mtime, path, size)`` for the chunks in
+        the directory.
+
+        '''
+        res = []
+        for dirpath, _, filenames in os.walk(self.directory):
+            if dirpath == self.directory:
+                continue  # the usage and the lock
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                try:
+                    if filename.endswith(self.TEMP_SUFFIX):
+                        if remove_temps:
+                            os.unlink(path)
+                    else:
+                        stat = os.stat(path)
+                        res.append((stat.st_mtime, path, stat.st_size))
+                except EnvironmentError:
+                    pass
+        return res
+
+    def get(self, key):
+        '''Return the data of the chunk with the `key` or None.'''
+        path = self._path(self._filename(key))
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except EnvironmentError:
+            return None
+        try:
+            os.utime(path, None)  # recently used
+        except EnvironmentError:
+            pass
+        return data
+
+    def put(self, key, data):
+        '''Keep `data` as the chunk with the `key`.
+
+        Errors writing to the disk are ignored: the chunk is not cached.
+
+        '''
+        import tempfile
+        size = len(data)
+        if size > self.size:
+            return
+        path = self._path(self._filename(key))
+        temp = None
+        try:
+            dirname = os.path.dirname(path)
+            _makedirs(dirname)
+            fd, temp = tempfile.mkstemp(suffix=self.TEMP_SUFFIX, dir=dirname)
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            with self._locked():
+                previous = _getsize(path) or 0
+                _replace(temp, path)
+                temp = None
+                self._add_usage(size - previous)
+        except EnvironmentError:
+            if temp is not None:
+                _unlink(temp)
+
+    def discard(self, key):
+        '''Remove the chunk with the `key` if it's in the cache.'''
+        path = self._path(self._filename(key))
+        try:
+            with self._locked():
+                size = _getsize(path)
+                if size is not None:
+                    os.unlink(path)
+                    self._add_usage(-size)
+        except EnvironmentError:
+            pass
+
+    def evict(self):
+        '''Remove the least recently used chunks if they exceed `size`.'''
+        with self._locked():
+            self._collect()
+
+    def _add_usage(self, amount):
+        used = self._read_usage()
+        if used is None or used + amount > self.size:
+            self._collect()
+        else:
+            self._write_usage(max(used + amount, 0))
+
+    def _collect(self, remove_temps=False):
+        # Take the actual usage of the directory, and evict if needed.
+        # Called with the lock held.
+        chunks = self.scan(remove_temps=remove_temps)
+        used = sum(size for _, _, size in chunks)
+        if used > self.size:
+            chunks.sort()
+            for _, path, size in chunks:
+                if used <= self.LOW_WATER * self.size:
+                    break
+                _unlink(path)
+                used -= size
+        self._write_usage(used)
+        return used
+
+    def _read_usage(self):
+        try:
+            with open(os.path.join(self.directory, 'usage')) as f:
+                return int(f.read())
+        except (EnvironmentError, ValueError):
+            return None
+
+    def _write_usage(self, used):
+        with open(os.path.join(self.directory, 'usage'), 'w') as f:
+            f.write('%d' % used)
+
+    @contextmanager
+    def _locked(self):
+        import fcntl
+        # The lock is taken on a new file description, so it excludes the
+        # other threads as well.  It's released when the file is closed.
+        with open(os.path.join(self.directory, 'lock'), 'a') as f:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            yield
+
+    def _filename(self, key):
+        return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+    def _path(self, filename):
+        return os.path.join(self.directory, filename[:2], filename)
+
+
+#: A codec of chunks: its `id` (a byte in the header of the blob), and the
+#: functions that `compress` and `decompress` the data of a chunk.
+Codec = namedtuple('Codec', 'id name compress decompress')
+
+
+def _gzip_compress(data):
+    # Each chunk is a gzip member; a blob is thus a valid gzip stream (RFC
+    # 1952), which can be sent as is with 'Content-Encoding: gzip'.
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(_tobytes(data)) + compressor.flush()
+
+
+def _gzip_decompress(data):
+    return zlib.decompress(_tobytes(data), 16 + zlib.MAX_WBITS)
+
+
+def _codecs():
+    yield Codec(1, 'gzip', _gzip_compress, _gzip_decompress)
+    yield Codec(2, 'zlib',
+                lambda data: zlib.compress(_tobytes(data)),
+                lambda data: zlib.decompress(_tobytes(data)))
+    try:
+        import bz2
+    except ImportError:
+        pass
+    else:
+        yield Codec(3, 'bz2',
+                    lambda data: bz2.compress(_tobytes(data)),
+                    lambda data: bz2.decompress(_tobytes(data)))
+    try:
+        import lzma
+    except ImportError:
+        pass  # Python 2
+    else:
+        yield Codec(4, 'lzma',
+                    lambda data: lzma.compress(_tobytes(data)),
+                    lambda data: lzma.decompress(_tobytes(data)))
+
+
+#: The codecs available, by name.
+CODECS = {codec.name: codec for codec in _codecs()}
+
+#: The codecs available, by id.
+CODEC_IDS = {codec.id: codec for codec in CODECS.values()}
+
+
+#: The prefix of the keys of deduplicated chunks.
+CONTENT_PREFIX = 'sha256/'
+
+
+def content_key(digest):
+    '''Return the key of the deduplicated chunk with the given `digest`.'''
+    return CONTENT_PREFIX + _hex(digest)
+
+
+def _hex(digest):
+    return binascii.hexlify(digest).decode('ascii')
+
+
+def _tobytes(data):
+    if isinstance(data, memoryview):
+        return data.tobytes()
+    else:
+        return binary_type(data)
+
+
+_replace = getattr(os, 'replace', os.rename)
+
+
+def _unlink(path):
+    try:
+        os.unlink(path)
+    except EnvironmentError:
+        pass
+
+
+def _noop():
+    pass
+
+
+def _getsize(path):
+    try:
+        return os.path.getsize(path)
+    except EnvironmentError:
+        return None
+
+
+def _makedirs(path):
+    if not os.path.isdir(path):
+        try:
+            os.makedirs(path)
+        except EnvironmentError:
+            if not os.path.isdir(path):
+                raise
@@ -28,6 +28,7 @@ install_requires = [
     'six >= 1.8.0',
     'basho_erlastic >= 2.1.1',
     'flask>=0.12.2',
+    'futures>=3.0;python_version<"3.2"',
 ]
 
 if sys.version_info[:3] <= (2, 7, 9):
@@ -56,4 +57,14 @@ setup(
     include_package_data=True,
     zip_safe=False,
     install_requires=install_requires,
+    extras_require={
+        'asgi': ['uvicorn;python_version>="3.6"'],
+        'server': ['gunicorn>=19.9'],
+    },
+    entry_points={
+        'console_scripts': [
+            'kaircs = kaircs.service.server:main',
+            'kaircs-gc = kaircs.service.gc:main',
+        ],
+    },
 )
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# ---------------------------------------------------------------------
+# Copyright (c) Merchise Autrement [~º/~] and Contributors
+# All rights reserved.
+#
+# This is free software; you can do what the LICENCE file allows you to.
+#
+
+from __future__ import (division as _py3_division,
+                        print_function as _py3_print,
+                        absolute_import as _py3_abs_import)
+
+import io
+import sys
+import tarfile
+
+import pytest
+
+from kaircs.vsbs import Blob
+from kaircs.service.fs import Stat
+from kaircs.service.archive import tar_stream, zip_stream, get_name
+
+
+class FakeMetadata(object):
+    def __init__(self, size):
+        self.size = size
+
+
+class FakeBlob(object):
+    def __init__(self, size):
+        self.metadata = FakeMetadata(size)
+
+
+class FakeReader(io.BytesIO):
+    # Just what the archivers use of a `kaircs.vsbs.BlobReader`.
+    def __init__(self, data):
+        super(FakeReader, self).__init__(data)
+        self.blob = FakeBlob(len(data))
+
+
+FILES = {
+    'b/c.txt': b'hello',
+    'b/d/e': b'',
+    'b/d/big': b'x' * (2 * Blob.CHUNK_SIZE + 17),
+}
+
+
+def make_tree(path='/a/b'):
+    # The tree of `path` as yielded by `FileSystem.export_tree`.
+    parent = '/a'
+    yield make_stat(path, 'dir'), None
+    yield make_stat(parent + '/b/c.txt', 'file'), FakeReader(FILES['b/c.txt'])
+    yield make_stat(parent + '/b/d', 'dir'), None
+    for name in ('b/d/e', 'b/d/big'):
+        yield make_stat(parent + '/' + name, 'file'), FakeReader(FILES[name])
+
+
+def make_stat(name, kind, mtime=1539000000.0):
+    return Stat(name, kind, None, None, None, mtime, None)
+
+
+def test_get_name():
+    assert get_name('/a/b', '/a/b') == 'b'
+    assert get_name('/a/b/c', '/a/b') == 'b/c'
+    assert get_name('/x', '/') == 'x'
+    assert get_name('/', '/') is None
+
+
+def test_tar_stream():
+    pieces = list(tar_stream(make_tree(), '/a/b'))
+    # No piece is larger than a chunk.
+    assert max(len(piece) for piece in pieces) <= Blob.CHUNK_SIZE
+    data = b''.join(pieces)
+    assert len(data) % tarfile.RECORDSIZE == 0
+    with tarfile.open(fileobj=io.BytesIO(data)) as archive:
+        assert archive.getnames() == ['b', 'b/c.txt', 'b/d', 'b/d/e',
+                                      'b/d/big']
+        assert archive.getmember('b').isdir()
+        assert archive.getmember('b/d').isdir()
+        for name, contents in FILES.items():
+            member = archive.getmember(name)
+            assert member.isfile() and member.mtime == 1539000000
+            assert archive.extractfile(member).read() == contents
+
+
+def test_tar_stream_empty_root():
+    tree = [(make_stat('/', 'dir'), None)]
+    data = b''.join(tar_stream(iter(tree), '/'))
+    assert len(data) == tarfile.RECORDSIZE
+    with tarfile.open(fileobj=io.BytesIO(data)) as archive:
+        assert archive.getnames() == []
+
+
+@pytest.mark.skipif(sys.version_info < (3, 6),
+                    reason='zip_stream requires Python 3.6')
+def test_zip_stream():
+    import zipfile
+    data = b''.join(zip_stream(make_tree(), '/a/b'))
+    # The archive is not seekable: it must be readable as a stream.
+    with zipfile.ZipFile(io.BytesIO(data)) as archive:
+        assert archive.testzip() is None
+        assert archive.namelist() == ['b/', 'b/c.txt', 'b/d/', 'b/d/e',
+                                      'b/d/big']
+        assert archive.getinfo('b/d/').is_dir()
+        for name, contents in FILES.items():
+            assert archive.read(name) == contents
@@ -0,0 +1,42 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# ---------------------------------------------------------------------
+# Copyright (c) Merchise Autrement [~º/~] and Contributors
+# All rights reserved.
+#
+# This is free software; you can do what the LICENCE file allows you to.
+#
+
+from __future__ import (division as _py3_division,
+                        print_function as _py3_print,
+                        absolute_import as _py3_abs_import)
+
+import pytest
+
+from kaircs.service.config import load_config
+
+
+def test_config_file_and_environ(tmpdir):
+    filename = tmpdir.join('kaircs.ini')
+    filename.write('[kaircs]\n'
+                   'nodes = riak1:8098, riak2:8098:8087\n'
+                   'name = files\n'
+                   '[server]\n'
+                   'workers = 4\n')
+    config = load_config(str(filename), {'KAIRCS_WORKERS': '8'})
+    assert config['nodes'] == [
+        {'host': 'riak1', 'http_port': 8098},
+        {'host': 'riak2', 'http_port': 8098, 'pb_port': 8087},
+    ]
+    assert config['name'] == 'files'
+    assert config['workers'] == 8
+    assert config['dir_bucket_type'] == 'maps'
+    config = load_config(None, {'KAIRCS_CONFIG': str(filename)})
+    assert config['workers'] == 4
+
+
+def test_config_errors(tmpdir):
+    with pytest.raises(ValueError):
+        load_config(str(tmpdir.join('missing.ini')), {})
+    with pytest.raises(ValueError):
+        load_config(None, {'KAIRCS_MAX_REQUESTS': 'many'})
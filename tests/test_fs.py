@@ -164,3 +164,316 @@ def test_concurrent_read(path):
             assert c1 == c2
     fs._rmall()
     fs.close()
+
+
+@given(paths())
+@settings(max_examples=10)
+def test_dir_cache_invalidation(path):
+    import os
+    fs = FileSystem([{'host': '127.0.0.1', 'http_port': 8098}],
+                    'test_dir_cache_invalidation', dir_bucket_type='maps',
+                    dir_cache_size=100, dir_cache_ttl=60)
+    fpath = os.path.join(path, 'x')
+    assert not fs.exists(path)
+    fs.mkdir(path, exist_ok=True)
+    assert fs.isdir(path) and not fs.exists(fpath)
+    with fs.open(fpath, 'w') as f:
+        f.write(b'x')
+    assert fs.exists(fpath)
+    fs.rm(fpath)
+    assert not fs.exists(fpath)
+    fs.rm(path, recursive=True)
+    assert not fs.exists(path)
+    fs._rmall()
+    fs.close()
+
+
+def test_dir_cache_generation():
+    from kaircs.service.fs import DirectoryCache
+    cache = DirectoryCache(size=2, ttl=60)
+    generation = cache.generation('dir::/a')
+    # The directory changes while it's being fetched.
+    cache.invalidate('dir::/a')
+    cache.put('dir::/a', ({}, {}), generation)
+    assert cache.get('dir::/a') is None
+    cache.put('dir::/a', ({}, {}), cache.generation('dir::/a'))
+    assert cache.get('dir::/a') == ({}, {})
+    # Forgetting the generations doesn't let stale entries in.
+    generation = cache.generation('dir::/b')
+    for i in range(10):
+        cache.invalidate('dir::/%d' % i)
+    cache.put('dir::/b', ({}, {}), generation)
+    assert cache.get('dir::/b') is None
+
+
+@given(paths(min_size=2))
+@settings(max_examples=10)
+def test_stat(path):
+    import os
+    fs = FileSystem([{'host': '127.0.0.1', 'http_port': 8098}],
+                    'test_stat', dir_bucket_type='maps')
+    fs.mkdir(path, exists_ok=True)
+    fpath = os.path.join(path, 'x')
+    with fs.open(fpath, 'w') as f:
+        f.write(b'x')
+    stat = fs.stat(path)
+    assert stat.kind == 'dir' and stat.name == path
+    assert stat.parent == os.path.dirname(path)
+    stat = fs.stat(fpath)
+    assert stat.kind == 'file' and stat.parent == path
+    with pytest.raises(EnvironmentError):
+        fs.stat(os.path.join(fpath, 'y'))
+    fs._rmall()
+    fs.close()
+
+
+@given(paths(max_size=2))
+@settings(max_examples=10)
+def test_walk(path):
+    import os
+    fs = FileSystem([{'host': '127.0.0.1', 'http_port': 8098}],
+                    'test_walk', dir_bucket_type='maps')
+    for sub in ('a/x', 'a/z', 'b/y'):
+        fs.mkdir(os.path.join(path, sub), exist_ok=True)
+        with fs.open(os.path.join(path, sub, 'f'), 'w') as f:
+            f.write(b'x')
+    expected = {path, os.path.join(path, 'a'), os.path.join(path, 'b')}
+    expected.update(os.path.join(path, sub) for sub in ('a/x', 'a/z', 'b/y'))
+    walked = {dirpath: (dirs, files) for dirpath, dirs, files in fs.walk(path)}
+    assert set(walked) == expected
+    assert sorted(walked[path][0]) == ['a', 'b']
+    assert walked[os.path.join(path, 'a/x')] == ([], ['f'])
+    pruned = []
+    for dirpath, dirs, _ in fs.walk(path):
+        pruned.append(dirpath)
+        if dirpath == path:
+            dirs.remove('a')
+    assert sorted(pruned) == [path, os.path.join(path, 'b'),
+                              os.path.join(path, 'b/y')]
+    fs.rm(path, recursive=True)
+    assert not fs.exists(path)
+    fs._rmall()
+    fs.close()
+
+
+@given(paths(max_size=2))
+@settings(max_examples=10)
+def test_background_rm(path):
+    import os
+    fs = FileSystem([{'host': '127.0.0.1', 'http_port': 8098}],
+                    'test_background_rm', dir_bucket_type='maps',
+                    delete_workers=2)
+    for i in range(6):
+        fs.mkdir(os.path.join(path, 'd%d' % (i % 3)), exist_ok=True)
+        with fs.open(os.path.join(path, 'd%d' % (i % 3), 'f%d' % i), 'w') as f:
+            f.write(b'x')
+    fs.rm(path, recursive=True, wait=False)
+    assert not fs.exists(path)
+    fs.deletions.wait(path)
+    status = fs.deletions.status(path)
+    assert status['state'] == 'done' and not status['errors']
+    assert status['files'] == status['deleted'] == 6
+    assert status['directories'] == 4
+    assert fs.deletion_status(path)['state'] == 'done'
+    fs.mkdir(os.path.join(path, 'd0'), exist_ok=True)
+    assert fs.ls(path) == [path, os.path.join(path, 'd0')]
+    fs._rmall()
+    fs.close()
+
+
+@given(paths(max_size=2))
+@settings(max_examples=10)
+def test_tombstone(path):
+    import os
+    import time
+    from kaircs.service.fs import Directory, Tombstone, FileInfo
+    fs = FileSystem([{'host': '127.0.0.1', 'http_port': 8098}],
+                    'test_tombstone', dir_bucket_type='maps')
+    fs.mkdir(os.path.join(path, 'd'), exist_ok=True)
+    with fs.open(os.path.join(path, 'd', 'f'), 'w') as f:
+        f.write(b'x')
+    # Another process is deleting the directory.
+    directory = os.path.join(path, 'd')
+    Directory(path, fs).set('d', Tombstone(directory, fs),
+                            FileInfo(0, time.time(), ''))
+    assert not fs.exists(directory)
+    assert fs.ls(path) == [path]
+    with pytest.raises(EnvironmentError):
+        fs.mkdir(os.path.join(directory, 'e'))
+    with pytest.raises(EnvironmentError):
+        fs.open(directory, 'w')
+    with pytest.raises(EnvironmentError):
+        fs.rm(directory, recursive=True)
+    assert fs.deletion_status(directory)['state'] == 'running'
+    results = fs.write_files(path, [('d/g', b'y', None)])
+    assert results[0].error
+    # The process was killed: the deletion is resumed.
+    stale = time.time() - 2 * Tombstone.TIMEOUT
+    Directory(path, fs).set('d', Tombstone(directory, fs),
+                            FileInfo(0, stale, ''))
+    assert fs.deletion_status(directory)['state'] == 'interrupted'
+    deletion = fs.rm(directory, recursive=True)
+    assert deletion.status()['state'] == 'done'
+    assert not fs.get_listing(Directory(path, fs).hash)[0]
+    with pytest.raises(KeyError):
+        fs.files.read(os.path.join(directory, 'f'))
+    fs.mkdir(directory)
+    assert fs.ls(directory) == [directory]
+    fs._rmall()
+    fs.close()
+
+
+@given(paths(max_size=2))
+@settings(max_examples=10)
+def test_scandir(path):
+    import os
+    fs = FileSystem([{'host': '127.0.0.1', 'http_port': 8098}],
+                    'test_scandir', dir_bucket_type='maps')
+    fs.mkdir(os.path.join(path, 'sub'), exist_ok=True)
+    with fs.open(os.path.join(path, 'f'), 'w') as f:
+        f.write(b'x')
+    entries = fs.scandir(path)
+    assert [(e.name, e.kind) for e in entries] == [
+        (os.path.join(path, 'f'), 'file'),
+        (os.path.join(path, 'sub'), 'dir'),
+    ]
+    assert fs.scandir(fs.stat(path)) == entries
+    with pytest.raises(EnvironmentError):
+        fs.scandir(os.path.join(path, 'f'))
+    fs._rmall()
+    fs.close()
+
+
+@given(paths(max_size=2))
+@settings(max_examples=10)
+def test_file_info(path):
+    import os
+    import time
+    fs = FileSystem([{'host': '127.0.0.1', 'http_port': 8098}],
+                    'test_file_info', dir_bucket_type='maps')
+    fs.mkdir(path, exist_ok=True)
+    fpath = os.path.join(path, 'x.txt')
+    start = time.time()
+    with fs.open(fpath, 'w') as f:
+        f.write(b'x' * 200)
+        assert not fs.exists(fpath)
+    stat = fs.stat(fpath)
+    assert stat.size == 200 and stat.content_type == 'text/plain'
+    assert start - 1 <= stat.mtime <= time.time() + 1
+    with fs.open(os.path.join(path, 'y'), 'w', content_type='image/png') as f:
+        f.write(b'y')
+    assert [(e.size, e.content_type) for e in fs.scandir(path)] == [
+        (200, 'text/plain'), (1, 'image/png')
+    ]
+    assert fs.stat(path).size is None
+    fs._rmall()
+    fs.close()
+
+
+@given(paths(max_size=2))
+@settings(max_examples=10)
+def test_write_files(path):
+    import os
+    from io import BytesIO
+    fs = FileSystem([{'host': '127.0.0.1', 'http_port': 8098}],
+                    'test_write_files', dir_bucket_type='maps',
+                    upload_workers=4)
+    files = [('d%d/f%d.txt' % (i % 3, i), b'x' * i, None) for i in range(10)]
+    files.append(('empty', None, None))
+    files.append(('s/stream', BytesIO(b'stream'), 'application/x-test'))
+    files.append(('x', b'file', None))
+    files.append(('q/r', b'deep', None))
+    # These collide with the entries above.
+    files.append(('d0/f0.txt', b'again', None))
+    files.append(('../outside', b'x', None))
+    files.append(('x/y/z', b'under a file', None))
+    files.append(('q', b'over a directory', None))
+    results = fs.write_files(path, files, batch_size=2)
+    assert [r.path for r in results] == [
+        os.path.normpath(os.path.join(path, name)) for name, _, _ in files
+    ]
+    assert [r.size for r in results[:10]] == list(range(10))
+    assert all(r.error for r in results[-4:])
+    assert not any(r.error for r in results[:-4])
+    assert fs.cat(os.path.join(path, 'x')) == b'file'
+    assert fs.cat(os.path.join(path, 'q', 'r')) == b'deep'
+    assert fs.isdir(os.path.join(path, 'empty'))
+    assert fs.cat(os.path.join(path, 'd1', 'f4.txt')) == b'x' * 4
+    stat = fs.stat(os.path.join(path, 's', 'stream'))
+    assert stat.size == 6 and stat.content_type == 'application/x-test'
+    assert len(fs.scandir(os.path.join(path, 'd0'))) == 4
+    fs._rmall()
+    fs.close()
+
+
+@given(paths(max_size=2))
+@settings(max_examples=10)
+def test_export_tree(path):
+    import os
+    fs = FileSystem([{'host': '127.0.0.1', 'http_port': 8098}],
+                    'test_export_tree', dir_bucket_type='maps')
+    files = {'a': b'a', 'd/b': b'b' * 100, 'd/e/c': b''}
+    fs.write_files(path, [(name, data, None)
+                          for name, data in sorted(files.items())])
+    exported = {}
+    for stat, reader in fs.export_tree(path, window=1):
+        name = os.path.relpath(stat.name, path)
+        if reader is None:
+            assert stat.kind == 'dir'
+            # Directories come before their entries.
+            assert name == '.' or (os.path.dirname(name) or '.') in exported
+            exported[name] = None
+        else:
+            exported[name] = reader.readall()
+    assert exported == dict(files, **{'.': None, 'd': None, 'd/e': None})
+    # A file that can't be read (its blob was deleted) is skipped.
+    fs.files.delete(os.path.join(path, 'd', 'b'))
+    exported = [
+        os.path.relpath(stat.name, path)
+        for stat, reader in fs.export_tree(path, window=1)
+    ]
+    assert sorted(exported) == ['.', 'a', 'd', 'd/e', 'd/e/c']
+    fs._rmall()
+    fs.close()
+
+
+@given(paths(max_size=2))
+@settings(max_examples=10)
+def test_garbage_collection(path):
+    import os
+    from kaircs.vsbs import Blob
+    from kaircs.service.gc import GarbageCollector
+    fs = FileSystem([{'host': '127.0.0.1', 'http_port': 8098}],
+                    'test_garbage_collection', dir_bucket_type='maps')
+    filename = os.path.join(path, 'file')
+    fs.mkdir(path, exist_ok=True)
+    data = b'x' * (Blob.CHUNK_SIZE + 1)
+    with fs.open(filename, 'w') as f:
+        f.write(data)
+    # A blob not in any directory, and a dirty one.
+    fs.files.write('orphan', data)
+    writer = fs.files.open('dirty', 'w')
+    writer.write(data)
+    writer.flush()
+    stats = GarbageCollector(fs, rate=0, grace=3600).collect()
+    assert stats['recent'] >= 2 and not stats['errors']
+    stats = GarbageCollector(fs, rate=0, grace=0).collect()
+    assert stats['collected'] >= 2 and not stats['errors']
+    with pytest.raises(KeyError):
+        fs.files.read('orphan')
+    with pytest.raises(KeyError):
+        fs.files.read('dirty')
+    assert fs.cat(filename) == data
+    fs._rmall()
+    fs.close()
+
+
+@given(paths())
+def test_normalize(path):
+    import os
+    from kaircs.service.fs import normalize
+    assert normalize(path) == path
+    assert normalize('/' + path + '/') == path
+    assert normalize(path.replace('/', '//')) == path
+    assert normalize(os.path.join(path, 'x', '..', '.')) == path
+    assert normalize('/..' + path) == path
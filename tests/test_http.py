@@ -0,0 +1,394 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# ---------------------------------------------------------------------
+# Copyright (c) Merchise Autrement [~º/~] and Contributors
+# All rights reserved.
+#
+# This is free software; you can do what the LICENCE file allows you to.
+#
+
+from __future__ import (division as _py3_division,
+                        print_function as _py3_print,
+                        absolute_import as _py3_abs_import)
+
+import io
+import sys
+import json
+import gzip
+import tarfile
+
+import pytest
+
+from kaircs.vsbs import Blob
+from kaircs.service.fs import FileSystem
+from kaircs.service.http import KairCSApplication, FileStream
+
+
+def make_client(name, **options):
+    fs = FileSystem([{'host': '127.0.0.1', 'http_port': 8098}], name,
+                    dir_bucket_type='maps', **options)
+    return fs, KairCSApplication(fs).test_client()
+
+
+def get_json(response):
+    return json.loads(response.data.decode('utf-8'))
+
+
+def make_tar(entries, mode='w'):
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode=mode) as archive:
+        for name, data in entries:
+            info = tarfile.TarInfo(name)
+            if data is None:
+                info.type = tarfile.DIRTYPE
+                archive.addfile(info)
+            else:
+                info.size = len(data)
+                archive.addfile(info, io.BytesIO(data))
+    return buffer.getvalue()
+
+
+def test_head_and_etag():
+    fs, client = make_client('test_http_head_and_etag')
+    assert client.put('/d/a.txt', data=b'hello').status_code == 201
+    response = client.head('/d/a.txt')
+    assert response.status_code == 200 and response.data == b''
+    assert response.headers['Content-Length'] == '5'
+    assert response.headers['Content-Type'] == 'text/plain'
+    assert response.headers['Accept-Ranges'] == 'bytes'
+    etag = response.headers['ETag']
+    response = client.get('/d/a.txt')
+    assert response.data == b'hello' and response.headers['ETag'] == etag
+    response = client.get('/d/a.txt', headers={'If-None-Match': etag})
+    assert response.status_code == 304 and response.data == b''
+    response = client.get('/d/a.txt', headers={'If-None-Match': '"other"'})
+    assert response.status_code == 200 and response.data == b'hello'
+    assert client.get('/d/missing').status_code == 404
+    fs._rmall()
+    fs.close()
+
+
+def test_range():
+    fs, client = make_client('test_http_range')
+    data = b''.join(b'%08d' % i for i in range(Blob.CHUNK_SIZE // 4))
+    size = len(data)
+    assert size > Blob.CHUNK_SIZE
+    client.put('/big', data=data)
+    etag = client.head('/big').headers['ETag']
+    response = client.get('/big', headers={'Range': 'bytes=5-9'})
+    assert response.status_code == 206 and response.data == data[5:10]
+    assert response.headers['Content-Range'] == 'bytes 5-9/%d' % size
+    assert response.headers['Content-Length'] == '5'
+    # A range across the boundary of chunks.
+    start = Blob.CHUNK_SIZE - 3
+    response = client.get('/big', headers={
+        'Range': 'bytes=%d-%d' % (start, start + 9)
+    })
+    assert response.status_code == 206
+    assert response.data == data[start:start + 10]
+    response = client.get('/big', headers={'Range': 'bytes=-4'})
+    assert response.status_code == 206 and response.data == data[-4:]
+    response = client.get('/big', headers={'Range': 'bytes=%d-' % size})
+    assert response.status_code == 416
+    assert response.headers['Content-Range'] == 'bytes */%d' % size
+    # Multiple ranges are not supported, the whole file is sent.
+    response = client.get('/big', headers={'Range': 'bytes=0-1,4-5'})
+    assert response.status_code == 200 and response.data == data
+    response = client.get('/big', headers={'Range': 'bytes=5-9',
+                                           'If-Range': etag})
+    assert response.status_code == 206 and response.data == data[5:10]
+    response = client.get('/big', headers={'Range': 'bytes=5-9',
+                                           'If-Range': '"other"'})
+    assert response.status_code == 200 and response.data == data
+    response = client.get('/big', headers={
+        'Range': 'bytes=5-9',
+        'If-Range': 'Thu, 01 Jan 2015 00:00:00 GMT'
+    })
+    assert response.status_code == 200
+    fs._rmall()
+    fs.close()
+
+
+def test_file_stream_contents():
+    fs, client = make_client('test_http_file_stream_contents')
+    data = b'x' * (2 * Blob.CHUNK_SIZE + 100)
+    client.put('/f', data=data)
+    response = client.get('/f')
+    assert response.headers['Content-Length'] == str(len(data))
+    assert response.data == data
+    # Pieces end at the boundaries of chunks.
+    stream = FileStream(None, '/f')
+    with fs.open('/f', 'r') as reader:
+        reader.seek(10)
+        pieces = list(stream.contents(reader, len(data) - 20))
+    assert [len(piece) for piece in pieces] == [
+        Blob.CHUNK_SIZE - 10, Blob.CHUNK_SIZE, 90
+    ]
+    fs._rmall()
+    fs.close()
+
+
+def test_gzip():
+    fs, client = make_client('test_http_gzip',
+                             store_options=dict(compression='gzip'))
+    text = b''.join(b'line %d\n' % i for i in range(200000))
+    assert len(text) > Blob.CHUNK_SIZE
+    client.put('/log.txt', data=text)
+    response = client.get('/log.txt')
+    assert response.data == text
+    assert 'Content-Encoding' not in response.headers
+    response = client.get('/log.txt', headers={'Accept-Encoding': 'gzip'})
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert 'Accept-Encoding' in response.headers['Vary']
+    assert gzip.GzipFile(fileobj=io.BytesIO(response.data)).read() == text
+    etag = response.headers['ETag']
+    assert etag != client.get('/log.txt').headers['ETag']
+    response = client.get('/log.txt', headers={'Accept-Encoding': 'gzip',
+                                               'If-None-Match': etag})
+    assert response.status_code == 304
+    assert 'Accept-Encoding' in response.headers['Vary']
+    # Ranges are taken from the uncompressed file.
+    response = client.get('/log.txt', headers={'Accept-Encoding': 'gzip',
+                                               'Range': 'bytes=10-19'})
+    assert response.status_code == 206 and response.data == text[10:20]
+    assert 'Content-Encoding' not in response.headers
+    response = client.get('/log.txt', headers={'Accept-Encoding': 'gzip;q=0'})
+    assert 'Content-Encoding' not in response.headers
+    fs._rmall()
+    fs.close()
+
+
+def test_json_listing():
+    fs, client = make_client('test_http_json_listing')
+    for i in range(7):
+        client.put('/l/f%d.txt' % i, data=b'x' * i)
+    client.put('/l/sub/x', data=b'x')
+    names, cursor = [], None
+    while True:
+        query = {'format': 'json', 'limit': 3}
+        if cursor is not None:
+            query['cursor'] = cursor
+        page = get_json(client.get('/l', query_string=query))
+        assert page['path'] == '/l' and len(page['entries']) <= 3
+        names.extend(entry['name'] for entry in page['entries'])
+        cursor = page['next']
+        if cursor is None:
+            break
+    assert names == ['f%d.txt' % i for i in range(7)] + ['sub']
+    entries = get_json(client.get('/l?format=json'))['entries']
+    assert entries[-1] == {'name': 'sub', 'kind': 'dir'}
+    assert entries[2]['kind'] == 'file' and entries[2]['size'] == 2
+    assert entries[2]['content_type'] == 'text/plain'
+    assert client.get('/l?format=json&limit=0').status_code == 400
+    assert client.get('/l?format=json&limit=x').status_code == 400
+    html = client.get('/l').data.decode('utf-8')
+    assert '<a href="./sub/">sub/</a>' in html
+    fs._rmall()
+    fs.close()
+
+
+def test_bulk_upload():
+    fs, client = make_client('test_http_bulk_upload')
+    big = b'b' * (Blob.CHUNK_SIZE + 5)
+    body = make_tar([('d', None), ('d/a.txt', b'aaa'), ('d/e/b', big),
+                     ('../outside', b'x')], mode='w:gz')
+    response = client.post('/t', data=body, content_type='application/gzip')
+    assert response.status_code == 200
+    manifest = get_json(response)
+    assert manifest['path'] == '/t' and manifest['errors'] == 1
+    assert [result['path'] for result in manifest['files']] == [
+        '/t/d', '/t/d/a.txt', '/t/d/e/b', '/outside'
+    ]
+    assert fs.cat('/t/d/a.txt') == b'aaa' and fs.cat('/t/d/e/b') == big
+    response = client.post('/m', content_type='multipart/form-data', data={
+        'one': (io.BytesIO(b'one'), 'x/one.txt'),
+        'big': (io.BytesIO(big), 'x/big'),
+    })
+    assert response.status_code == 200
+    assert get_json(response)['errors'] == 0
+    assert fs.cat('/m/x/one.txt') == b'one' and fs.cat('/m/x/big') == big
+    response = client.post('/t', data=b'garbage',
+                           content_type='application/x-tar')
+    assert response.status_code == 400
+    truncated = make_tar([('z', b'z' * 1000)])[:700]
+    response = client.post('/t', data=truncated,
+                           content_type='application/x-tar')
+    assert response.status_code == 400
+    response = client.post('/t', data=b'garbage', content_type='text/plain')
+    assert response.status_code == 415
+    fs._rmall()
+    fs.close()
+
+
+def test_archive():
+    fs, client = make_client('test_http_archive')
+    files = {'p/a.txt': b'aaa', 'p/q/b': b'b' * (Blob.CHUNK_SIZE + 1),
+             'p/q/c': b''}
+    for name, data in files.items():
+        client.put('/' + name, data=data)
+    response = client.get('/p?archive=tar')
+    assert response.status_code == 200
+    assert response.headers['Content-Type'] == 'application/x-tar'
+    assert response.headers['Content-Disposition'] == (
+        'attachment; filename="p.tar"'
+    )
+    with tarfile.open(fileobj=io.BytesIO(response.data)) as archive:
+        assert sorted(archive.getnames()) == ['p', 'p/a.txt', 'p/q',
+                                              'p/q/b', 'p/q/c']
+        for name, data in files.items():
+            assert archive.extractfile(name).read() == data
+    if sys.version_info >= (3, 6):
+        import zipfile
+        response = client.get('/p?archive=zip')
+        assert response.headers['Content-Type'] == 'application/zip'
+        with zipfile.ZipFile(io.BytesIO(response.data)) as archive:
+            assert archive.testzip() is None
+            for name, data in files.items():
+                assert archive.read(name) == data
+    response = client.get('/?archive=tar')
+    assert response.headers['Content-Disposition'] == (
+        'attachment; filename="root.tar"'
+    )
+    assert client.get('/p?archive=rar').status_code == 400
+    fs._rmall()
+    fs.close()
+
+
+def test_delete():
+    fs, client = make_client('test_http_delete')
+    client.put('/d/e/f', data=b'x')
+    response = client.delete('/d')
+    assert response.status_code == 202
+    assert response.headers['Location'].endswith('/d?deletion')
+    fs.deletions.wait('/d')
+    status = get_json(client.get('/d?deletion'))
+    assert status['path'] == '/d' and status['state'] == 'done'
+    assert client.get('/d/e/f').status_code == 404
+    assert client.delete('/d').status_code == 404
+    fs._rmall()
+    fs.close()
+
+
+asgi_only = pytest.mark.skipif(sys.version_info < (3, 6),
+                               reason='The ASGI application requires 3.6')
+
+
+@asgi_only
+def test_asgi_environ():
+    from kaircs.service.asgi import get_environ
+    environ = get_environ({
+        'type': 'http', 'method': 'GET', 'path': '/a b',
+        'query_string': b'format=json', 'server': ('example.com', 8000),
+        'headers': [(b'content-type', b'text/plain'),
+                    (b'accept-encoding', b'gzip'),
+                    (b'accept-encoding', b'br')],
+    })
+    assert environ['REQUEST_METHOD'] == 'GET'
+    assert environ['PATH_INFO'] == '/a b'
+    assert environ['QUERY_STRING'] == 'format=json'
+    assert environ['SERVER_NAME'] == 'example.com'
+    assert environ['SERVER_PORT'] == '8000'
+    assert environ['CONTENT_TYPE'] == 'text/plain'
+    assert environ['HTTP_ACCEPT_ENCODING'] == 'gzip,br'
+
+
+def call_asgi(app, method, path, body=b'', headers=None, query_string=b''):
+    '''Perform a request to the ASGI `app`.
+
+    Return the status, the headers (as a dict) and the body.
+
+    '''
+    import asyncio
+    scope = {
+        'type': 'http', 'method': method, 'path': path,
+        'query_string': query_string, 'http_version': '1.1',
+        'headers': [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                    for name, value in (headers or {}).items()],
+    }
+    # Send the body in a few messages.
+    step = max(1, len(body) // 3)
+    messages = [
+        {'type': 'http.request', 'body': body[i:i + step],
+         'more_body': i + step < len(body)}
+        for i in range(0, len(body), step)
+    ] or [{'type': 'http.request', 'body': b''}]
+    result = {}
+
+    loop = asyncio.new_event_loop()
+
+    # Not coroutines, so that this module compiles in Python 2.
+    def done(value=None):
+        future = loop.create_future()
+        future.set_result(value)
+        return future
+
+    def receive():
+        return done(messages.pop(0))
+
+    def send(message):
+        if message['type'] == 'http.response.start':
+            result.update(status=message['status'], body=b'', headers={
+                name.decode('latin-1'): value.decode('latin-1')
+                for name, value in message['headers']
+            })
+        else:
+            result['body'] += message.get('body', b'')
+        return done()
+
+    try:
+        loop.run_until_complete(app(scope, receive, send))
+    finally:
+        loop.close()
+    return result['status'], result['headers'], result['body']
+
+
+@asgi_only
+def test_asgi_parity():
+    from kaircs.service.asgi import AsyncKairCSApplication
+    fs, client = make_client('test_http_asgi_parity')
+    app = AsyncKairCSApplication(fs, workers=2)
+    data = b'abcdefgh' * (Blob.CHUNK_SIZE // 6)
+    status, _, _ = call_asgi(app, 'PUT', '/x/big.txt', data)
+    assert status == 201 and fs.cat('/x/big.txt') == data
+    status, _, _ = call_asgi(app, 'POST', '/t', make_tar([('a', b'a')]),
+                             headers={'Content-Type': 'application/x-tar'})
+    assert status == 200 and fs.cat('/t/a') == b'a'
+    etag = client.head('/x/big.txt').headers['ETag']
+    requests = [
+        ('GET', '/x/big.txt', {}, b''),
+        ('HEAD', '/x/big.txt', {}, b''),
+        ('GET', '/x/big.txt', {'If-None-Match': etag}, b''),
+        ('GET', '/x/big.txt', {'Range': 'bytes=5-9'}, b''),
+        ('GET', '/x/big.txt', {'Range': 'bytes=%d-' % len(data)}, b''),
+        ('GET', '/x', {}, b''),
+        ('GET', '/x', {}, b'format=json&limit=1'),
+        ('GET', '/x', {}, b'format=json&limit=0'),
+        ('GET', '/missing', {}, b''),
+        ('GET', '/x', {}, b'archive=rar'),
+        ('GET', '/missing', {}, b'deletion'),
+    ]
+    for method, path, headers, query_string in requests:
+        status, asgi_headers, body = call_asgi(app, method, path,
+                                               headers=headers,
+                                               query_string=query_string)
+        url = '%s?%s' % (path, query_string.decode('ascii'))
+        response = client.open(url, method=method, headers=headers)
+        assert status == response.status_code, (method, path, query_string)
+        if status < 400:
+            assert body == response.data
+            for name in ('Content-Type', 'Content-Length', 'ETag',
+                         'Content-Range'):
+                assert asgi_headers.get(name.lower()) == (
+                    response.headers.get(name)
+                )
+    for method, path in (('PUT', '/'), ('DELETE', '/'), ('PATCH', '/x')):
+        status, _, _ = call_asgi(app, method, path)
+        assert status == 405
+    status, headers, _ = call_asgi(app, 'DELETE', '/x')
+    assert status == 202 and headers['location'].endswith('/x?deletion')
+    fs.deletions.wait('/x')
+    status, _, body = call_asgi(app, 'GET', '/x', query_string=b'deletion')
+    assert status == 200 and b'"done"' in body
+    app.executor.shutdown()
+    fs._rmall()
+    fs.close()
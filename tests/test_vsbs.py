@@ -17,7 +17,7 @@ from __future__ import (division as _py3_division,
                         absolute_import as _py3_abs_import)
 
 import pytest
-from kaircs.vsbs import BlobStore, Blob, DirtyBlobError
+from kaircs.vsbs import BlobStore, Blob, DirtyBlobError, CODECS
 from hypothesis import given, example, strategies as s
 
 
@@ -102,3 +102,237 @@ def test_dirty_file(name):
     f.write('Hello World')
     with pytest.raises(DirtyBlobError):
         store.open(name, 'r')
+
+
+@given(s.binary(min_size=1), s.integers(min_value=1, max_value=4),
+       s.integers(min_value=0, max_value=6))
+@example(b'one_chunk', 1, 0)
+def test_readahead(name, n, readahead):
+    content = b'x' * (Blob.CHUNK_SIZE * n + 1)
+    store = BlobStore({'host': '127.0.0.1', 'http_port': 8098}, 'store',
+                      bucket_type=None)
+    with store.open(name, 'w') as f:
+        f.write(content)
+    result = []
+    with store.open(name, 'r', readahead=readahead) as f:
+        data = f.read()
+        while data:
+            result.append(data)
+            data = f.read()
+    retrieved = b''.join(result)
+    assert len(retrieved) == len(content)
+    assert retrieved == content
+    store.delete(name)
+
+
+# Riak KV doesn't read the objects of write once buckets ('vsbs') before
+# storing them.
+@pytest.mark.parametrize('bucket_type', [None, 'vsbs'])
+@given(name=s.binary(min_size=1), n=s.integers(min_value=0, max_value=2))
+@example(name=b'empty', n=0)
+def test_if_none_match(name, n, bucket_type):
+    content = b'x' * (Blob.CHUNK_SIZE * n + 1)
+    store = BlobStore({'host': '127.0.0.1', 'http_port': 8098}, 'store',
+                      bucket_type=bucket_type)
+    with store.open(name, 'w', if_none_match=True) as f:
+        f.write(content)
+    with pytest.raises(ValueError):
+        store.open(name, 'w', if_none_match=True)
+    assert store.read(name) == content
+    store.delete(name)
+
+
+@given(s.binary(min_size=1), s.integers(min_value=0, max_value=4),
+       s.integers(min_value=0, max_value=3))
+@example(b'one_chunk', 1, 1)
+def test_pipelined_writer(name, n, window):
+    content = b'x' * (Blob.CHUNK_SIZE * n + 1)
+    store = BlobStore({'host': '127.0.0.1', 'http_port': 8098}, 'store',
+                      bucket_type=None)
+    with store.open(name, 'w', window=window) as f:
+        f.write(content)
+    retrieved = store.read(name)
+    assert len(retrieved) == len(content)
+    assert retrieved == content
+    store.delete(name)
+
+
+@pytest.mark.parametrize('window', [0, 1, 2])
+def test_failed_writer(window, monkeypatch):
+    from kaircs.vsbs import BlobChunk
+    store = BlobStore({'host': '127.0.0.1', 'http_port': 8098}, 'store',
+                      bucket_type=None)
+    name = b'failed-writer'
+    store_chunk = BlobChunk.store
+
+    def fail_second(chunk, *args, **kwargs):
+        if chunk.index == 1:
+            raise IOError('Cannot store the chunk')
+        return store_chunk(chunk, *args, **kwargs)
+
+    monkeypatch.setattr(BlobChunk, 'store', fail_second)
+    with pytest.raises(IOError):
+        with store.open(name, 'w', window=window) as f:
+            f.write(b'x' * (3 * Blob.CHUNK_SIZE))
+    monkeypatch.undo()
+    # The blob was not completed.
+    with pytest.raises(DirtyBlobError):
+        store.read(name)
+    store.delete(name)
+
+
+@given(s.binary(min_size=1), s.integers(min_value=0, max_value=2),
+       s.integers(min_value=1, max_value=2 * Blob.CHUNK_SIZE))
+@example(b'one_chunk', 1, 4096)
+def test_buffered_reader(name, n, buffer_size):
+    import io
+    import shutil
+    content = b'x' * (Blob.CHUNK_SIZE * n + 1)
+    store = BlobStore({'host': '127.0.0.1', 'http_port': 8098}, 'store',
+                      bucket_type=None)
+    with store.open(name, 'w') as f:
+        f.write(content)
+    retrieved = io.BytesIO()
+    with store.open(name, 'r') as f:
+        assert f.readable()
+        shutil.copyfileobj(io.BufferedReader(f, buffer_size), retrieved)
+    assert retrieved.getvalue() == content
+    store.delete(name)
+
+
+@given(s.binary(min_size=1), s.integers(min_value=0, max_value=3),
+       s.integers(min_value=0), s.integers(min_value=0))
+@example(b'chunk_boundary', 2, Blob.CHUNK_SIZE - 1, Blob.CHUNK_SIZE + 1)
+def test_read_range_and_seek(name, n, start, length):
+    content = b''.join(
+        (b'%d' % i) * (Blob.CHUNK_SIZE // 2) for i in range(2 * n + 1)
+    )
+    start = start % (len(content) + 1)
+    end = start + length
+    store = BlobStore({'host': '127.0.0.1', 'http_port': 8098}, 'store',
+                      bucket_type=None)
+    with store.open(name, 'w') as f:
+        f.write(content)
+    assert store.read_range(name, start, end) == content[start:end]
+    with store.open(name, 'r', readahead=2) as f:
+        assert f.seekable()
+        assert f.seek(start) == start
+        assert f.read(length or 1) == content[start:start + (length or 1)]
+    store.delete(name)
+
+
+@given(s.binary(min_size=1), s.integers(min_value=0, max_value=3),
+       s.integers(min_value=0, max_value=2))
+@example(b'repeated', 2, 1)
+def test_dedup(name, n, window):
+    content = b'x' * (Blob.CHUNK_SIZE * n + 1)
+    store = BlobStore({'host': '127.0.0.1', 'http_port': 8098}, 'store',
+                      bucket_type=None, dedup=True)
+    names = [name, name + b'-copy']
+    for each in names:
+        with store.open(each, 'w', window=window) as f:
+            f.write(content)
+    for each in names:
+        assert store.read(each) == content
+    store.delete(names[0])
+    assert store.read(names[1]) == content
+    store.delete(names[1])
+    with pytest.raises(KeyError):
+        store.read(names[1])
+
+
+@given(s.sampled_from(sorted(CODECS)), s.binary(),
+       s.integers(min_value=0, max_value=2), s.booleans())
+@example('gzip', b'text ' * Blob.CHUNK_SIZE, 2, False)
+def test_compression(codec, content, window, dedup):
+    store = BlobStore({'host': '127.0.0.1', 'http_port': 8098}, 'store',
+                      bucket_type=None, compression=codec, dedup=dedup)
+    name = b'compressed-' + codec.encode('ascii')
+    with store.open(name, 'w', window=window) as f:
+        f.write(content)
+    # Any store reads it: the codec is in the header of the blob.
+    plain = BlobStore({'host': '127.0.0.1', 'http_port': 8098}, 'store',
+                      bucket_type=None)
+    assert plain.read(name) == content
+    start = len(content) // 3
+    assert plain.read_range(name, start) == content[start:]
+    with plain.open(name, 'r', readahead=2) as f:
+        encoded = list(f.iter_encoded())
+        assert len(encoded) == f.blob.length
+    store.delete(name)
+
+
+@pytest.mark.parametrize('bucket_type', [None, 'vsbs'])
+@given(content=s.binary(max_size=2048), dedup=s.booleans())
+@example(content=b'', dedup=False)
+def test_small_blob(content, dedup, bucket_type):
+    store = BlobStore({'host': '127.0.0.1', 'http_port': 8098}, 'store',
+                      bucket_type=bucket_type, dedup=dedup,
+                      small_blob_size=1024)
+    name = b'small'
+    with store.open(name, 'w') as f:
+        f.write(content)
+    try:
+        assert store.read(name) == content
+        with pytest.raises(ValueError):
+            store.write(name, b'overwrite')
+        assert store.read(name) == content
+    finally:
+        store.delete(name)
+
+
+@given(s.binary(min_size=1), s.integers(min_value=0, max_value=4),
+       s.integers(min_value=0, max_value=3), s.booleans())
+@example(b'parallel', 4, 2, False)
+def test_delete(name, n, window, dedup):
+    content = b''.join((b'%d' % i) * Blob.CHUNK_SIZE for i in range(n))
+    store = BlobStore({'host': '127.0.0.1', 'http_port': 8098}, 'store',
+                      bucket_type=None, dedup=dedup)
+    with store.open(name, 'w') as f:
+        f.write(content + b'!')
+    blob = store.get_blob(name)
+    blob.delete(window=window)
+    with pytest.raises(KeyError):
+        store.read(name)
+    for i in range(blob.length):
+        assert not store.bucket.get('%s/%d' % (blob.master_key, i)).exists
+    # Deleting a missing blob is a no-op.
+    store.delete(name, window=window)
+
+
+@given(s.binary(min_size=1), s.integers(min_value=1, max_value=3),
+       s.booleans())
+@example(b'cached', 2, False)
+def test_chunk_cache(name, n, dedup):
+    import shutil
+    import tempfile
+    from riak import RiakObject
+    content = b''.join((b'%d' % i) * Blob.CHUNK_SIZE for i in range(n + 1))
+    directory = tempfile.mkdtemp()
+    try:
+        store = BlobStore({'host': '127.0.0.1', 'http_port': 8098}, 'store',
+                          bucket_type=None, dedup=dedup,
+                          chunk_cache_dir=directory)
+        store.write(name, content)
+        assert store.read(name) == content
+        assert len(store.cache.scan()) == n + (1 if dedup else 0)
+        # The chunks are read from the cache...
+        blob = store.get_blob(name)
+        RiakObject(store.riak, store.bucket,
+                   '%s/1' % blob.master_key).delete()
+        if not dedup:
+            assert store.read(name) == content
+        # ... also by another store, which shares the budget.
+        other = BlobStore({'host': '127.0.0.1', 'http_port': 8098},
+                          'store', bucket_type=None,
+                          chunk_cache_dir=directory,
+                          chunk_cache_size=2 * Blob.CHUNK_SIZE)
+        chunks = other.cache.scan()
+        assert store.cache.used == sum(size for _, _, size in chunks)
+        assert store.cache.used <= 2 * Blob.CHUNK_SIZE
+        store.delete(name)
+        assert not store.cache.scan() and not other.cache.used
+        with pytest.raises(KeyError):
+            store.read(name)
+    finally:
+        shutil.rmtree(directory)